@@ -0,0 +1,50 @@
+from tin.parser import parser, ParsingError
+from tin.compiler import compiler
+from tin.AST import Paragraph
+
+from sys import argv
+from time import perf_counter
+
+
+'''
+Compile time against program size for generated programs.
+The sentences are parsed once and repeated to reach the
+requested size, so only the compiler is measured.
+Run from the repository root:
+    python -m benchmarks.compiler_scaling [sentences ...]
+'''
+
+
+SENTENCES = '''\
+ijo I li nanpa ale ale luka tu wan.
+ijo lili Nimi li nimi "toki" en nimi " " en nimi "ma".
+ijo I li suli la ijo I li nanpa wan la ijo suli Kulupu pi ijo I li ijo I ala.
+ijo I en nanpa wan ala li suli la o sitelen e ijo Nimi pi ijo I kepeken ijo Lipu.
+ijo lili Nimi li kipisi e ijo Nimi kepeken nanpa wan kepeken ijo I en ijo I en ijo I.
+ijo A li ijo E la ijo O li ijo U la o pana e ijo A en ijo E en ijo O en ijo U.
+o pali e ijo Sike kepeken ijo I kepeken ijo Nimi kepeken kulupu.
+ijo I li ijo I en nanpa wan ala.
+'''
+
+
+def generate(sentences):
+    ast = parser(SENTENCES)
+    assert not isinstance(ast, ParsingError), str(ast)
+    template = ast.sentences
+    return Paragraph([], [template[n % len(template)]
+                          for n in range(sentences)])
+
+
+def main(sizes):
+    print(f'{"sentences":>10} {"seconds":>9} {"us/sentence":>12} {"bytes":>10}')
+    for size in sizes:
+        ast = generate(size)
+        start = perf_counter()
+        compiled = compiler(ast)
+        elapsed = perf_counter() - start
+        print(f'{size:>10} {elapsed:>9.3f} {elapsed / size * 1e6:>12.1f} '
+              f'{len(compiled):>10}')
+
+
+if __name__ == '__main__':
+    main([int(a) for a in argv[1:]] or [1_000, 10_000, 100_000, 1_000_000])
@@ -0,0 +1,46 @@
+from tin.environment import Environment
+
+from sys import argv
+from timeit import Timer
+
+
+'''
+Cost of call frame operations at different call depths.
+Run from the repository root:
+    python -m benchmarks.environment [depth ...]
+'''
+
+
+OPERATIONS = [
+    ('new frame', 'Environment(env)'),
+    ('local get', 'env.get_local(0)'),
+    ('local set', 'env.set_local(0, 1)'),
+    ('global get', 'env.get_global(1)'),
+    ('global set', 'env.set_global(1, 1)'),
+]
+
+
+def chain(depth):
+    env = Environment()
+    env.set_global(1, 0)
+    for _ in range(depth - 1):
+        env = Environment(env)
+    env.set_local(0, 0)
+    return env
+
+
+def measure(statement, env, number=20_000):
+    timer = Timer(statement, globals={'Environment': Environment, 'env': env})
+    return min(timer.repeat(3, number)) / number
+
+
+def main(depths):
+    print(f'{"ns/op":>12}' + ''.join(f'{f"depth {d}":>13}' for d in depths))
+    envs = [chain(depth) for depth in depths]
+    for name, statement in OPERATIONS:
+        print(f'{name:>12}' + ''.join(f'{measure(statement, env) * 1e9:>13.1f}'
+                                      for env in envs))
+
+
+if __name__ == '__main__':
+    main([int(a) for a in argv[1:]] or [1, 100, 10_000])
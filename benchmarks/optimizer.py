@@ -0,0 +1,68 @@
+from tin.parser import parser, ParsingError
+from tin.optimizer import optimize
+from tin.compiler import compiler
+from tin.virtual_machine import Machine, load
+from tin.output import output
+
+from sys import argv
+from io import StringIO
+from contextlib import redirect_stdout
+from unittest.mock import patch
+import os
+
+
+'''
+Runs the programs of the corpus with and without the optimizer,
+checks that their output is the same and compares the size of
+their bytecode and the number of executed instructions.
+Run from the repository root:
+    python -m benchmarks.optimizer [level]
+'''
+
+
+CORPUS = os.path.join(os.path.dirname(__file__), 'corpus')
+
+# Programs reading input, with what they get
+INPUTS = {'FizzBuzz.tin': '100\n'}
+
+PROGRAMS = [os.path.join(CORPUS, name) for name in sorted(os.listdir(CORPUS))] + \
+           [os.path.join('examples', 'FizzBuzz.tin')]
+
+
+def run(compiled, stdin):
+    '''
+    Returns the output, the result and the number of executed instructions.
+    '''
+    vm = Machine(load(compiled), [])
+    out = StringIO()
+    steps = 0
+    with redirect_stdout(out), patch('sys.stdin', StringIO(stdin)):
+        while True:
+            handler, operand = vm.code[vm.ip]
+            vm.ip += 1
+            steps += 1
+            if handler(vm, operand):
+                output.flush()
+                break
+    return out.getvalue(), vm.data[-1], steps
+
+
+def main(level):
+    print(f'{"program":>16} {"bytes":>7} {"-O" + str(level):>7} '
+          f'{"instructions":>13} {"-O" + str(level):>9}')
+    for path in PROGRAMS:
+        with open(path, 'r') as f:
+            ast = parser(f.read())
+        assert not isinstance(ast, ParsingError), str(ast)
+        stdin = INPUTS.get(os.path.basename(path), '')
+        plain = compiler(ast)
+        optimized = compiler(optimize(ast, level))
+        *plain_output, plain_steps = run(plain, stdin)
+        *optimized_output, optimized_steps = run(optimized, stdin)
+        assert plain_output == optimized_output, path
+        print(f'{os.path.basename(path):>16} {len(plain):>7} {len(optimized):>7} '
+              f'{plain_steps:>13} {optimized_steps:>9}')
+
+
+if __name__ == '__main__':
+    main(int(argv[1]) if len(argv) > 1 else 2)
@@ -0,0 +1,75 @@
+from tin import parser as parser_module
+from tin.parser import parser, ParsingError
+from benchmarks.parser_scaling import generate
+
+from sys import argv, setprofile
+import tracemalloc
+
+
+'''
+Memory allocated while parsing generated programs.
+Reports the tracemalloc peak, the number of blocks allocated
+by tin/parser.py per sentence of source and how many of them
+are still alive once the parse is over.
+
+Snapshots only see live blocks, and most of what the parser
+allocates (combinators built for a single call, failed results)
+is freed right away. To count it, the value returned by every
+function of tin/parser.py is kept alive until the snapshot.
+Run from the repository root:
+    python -m benchmarks.parser_allocations [lines ...]
+'''
+
+
+PARSER = parser_module.__file__
+
+ONLY_PARSER = [tracemalloc.Filter(True, PARSER)]
+
+
+def count_blocks(before, after) -> int:
+    '''
+    Number of blocks allocated by tin/parser.py between two snapshots.
+    '''
+    stats = after.filter_traces(ONLY_PARSER).compare_to(
+        before.filter_traces(ONLY_PARSER), 'lineno')
+    return sum(stat.count_diff for stat in stats)
+
+
+def count_allocations(source) -> int:
+    kept = []
+    def profile(frame, event, arg):
+        if event == 'return' and frame.f_code.co_filename == PARSER:
+            kept.append(arg)
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        setprofile(profile)
+        try:
+            parser(source)
+        finally:
+            setprofile(None)
+        return count_blocks(before, tracemalloc.take_snapshot())
+    finally:
+        tracemalloc.stop()
+
+
+def main(sizes):
+    print(f'{"sentences":>10} {"peak KiB":>10} {"B/sentence":>11} '
+          f'{"allocations/sentence":>21} {"live/sentence":>14}')
+    for size in sizes:
+        source = generate(size)
+        sentences = source.count('\n')
+        tracemalloc.start()
+        before = tracemalloc.take_snapshot()
+        ans = parser(source)
+        _, peak = tracemalloc.get_traced_memory()
+        live = count_blocks(before, tracemalloc.take_snapshot())
+        tracemalloc.stop()
+        assert not isinstance(ans, ParsingError), str(ans)
+        allocations = count_allocations(source)
+        print(f'{sentences:>10} {peak / 1024:>10.0f} {peak / sentences:>11.0f} '
+              f'{allocations / sentences:>21.1f} {live / sentences:>14.1f}')
+
+
+if __name__ == '__main__':
+    main([int(a) for a in argv[1:]] or [1_000, 10_000])
@@ -0,0 +1,55 @@
+from tin.parser import parser, ParsingError
+
+from sys import argv
+from time import perf_counter
+
+
+'''
+Parse time against source size for generated programs.
+Run from the repository root:
+    python -m benchmarks.parser_scaling [lines ...]
+'''
+
+
+BLOCK = '''\
+ijo Sike{name} li pali sin.
+    pali ni li kepeken e ijo I e ijo Nimi.
+    ijo lili Tenpo li ijo I en nanpa luka tu wan ala.
+    ijo Nimi pi ijo I li ijo Nimi pi ijo I en nimi "a\\n".
+    ijo I li lili la o pana e ijo Nimi.
+    ijo Tenpo li suli la ijo lili I li ijo I ala en nanpa wan.
+    ijo I li nanpa ala la o sitelen e nimi "{n}".
+    o pali e pali sin kepeken ijo I.
+        pali ni li kepeken e ijo Ko.
+        ijo Ko en nanpa wan ala li suli la o pali e pali ni kepeken ijo Ko en nanpa wan ala.
+    pali sin li pini.
+    o pali e pali ni kepeken ijo I en nanpa wan ala kepeken ijo Nimi.
+pali sin li pini.
+ijo Nanpa li pali e ijo Sike{name} kepeken nanpa mute mute luka tu kepeken kulupu.
+'''
+
+
+SYLLABLES = ['ka', 'la', 'ma', 'pa', 'sa', 'ta', 'wa', 'ke', 'le', 'me']
+
+
+def generate(lines):
+    block_lines = BLOCK.count('\n')
+    return ''.join(BLOCK.format(n=n, name=''.join(SYLLABLES[int(d)]
+                                                  for d in str(n)))
+                   for n in range(max(1, lines // block_lines)))
+
+
+def main(sizes):
+    print(f'{"lines":>8} {"seconds":>9} {"us/line":>9}')
+    for size in sizes:
+        source = generate(size)
+        lines = source.count('\n')
+        start = perf_counter()
+        ans = parser(source)
+        elapsed = perf_counter() - start
+        assert not isinstance(ans, ParsingError), str(ans)
+        print(f'{lines:>8} {elapsed:>9.3f} {elapsed / lines * 1e6:>9.1f}')
+
+
+if __name__ == '__main__':
+    main([int(a) for a in argv[1:]] or [10_000, 25_000, 50_000, 100_000])
@@ -0,0 +1,64 @@
+from tin.parser import parser, ParsingError
+from benchmarks.suite import ENGINES, quietly
+
+from sys import argv
+from time import perf_counter
+
+
+'''
+Time to build a string of up to 10 MB by adding PIECE to it
+with en again and again, like FizzBuzz builds its output, in every
+engine. The string is indexed with pi at the end, so it's flattened
+once within the measured time. With linear appends the seconds per
+megabyte stay about the same as the size grows.
+Run from the repository root:
+    python -m benchmarks.string_building [megabytes ...]
+'''
+
+
+PIECE = 'toki pona ' * 10
+
+NUMBERS = [(100, 'ale'), (20, 'mute'), (5, 'luka'), (2, 'tu'), (1, 'wan')]
+
+
+def number(n: int) -> str:
+    words = []
+    for value, word in NUMBERS:
+        words += [word] * (n // value)
+        n %= value
+    return 'nanpa ' + (' '.join(words) or 'ala')
+
+
+def generate(megabytes: float) -> str:
+    appends = int(megabytes * 1_000_000) // len(PIECE)
+    return f'''\
+ijo Nimi li nimi "".
+ijo I li {number(appends)}.
+o pali e pali sin.
+    ijo Nimi li ijo Nimi en nimi "{PIECE}".
+    ijo I li ijo I en nanpa wan ala.
+    ijo I li suli la o pali e pali ni.
+pali sin li pini.
+o pana e ijo Nimi pi {number(appends * len(PIECE) - 1)}.
+'''
+
+
+def main(sizes):
+    print(f'{"MB":>6} {"engine":>9} {"seconds":>9} {"s/MB":>8}')
+    for size in sizes:
+        ast = parser(generate(size))
+        assert not isinstance(ast, ParsingError), str(ast)
+        expected = None
+        for engine, (compile_code, run) in ENGINES.items():
+            code = ast if compile_code is None else compile_code(ast)
+            start = perf_counter()
+            ans, _ = quietly(lambda: run(code), '')
+            elapsed = perf_counter() - start
+            if expected is None:
+                expected = ans
+            assert ans == expected, (size, engine)
+            print(f'{size:>6g} {engine:>9} {elapsed:>9.3f} {elapsed / size:>8.3f}')
+
+
+if __name__ == '__main__':
+    main([float(a) for a in argv[1:]] or [1, 2, 5, 10])
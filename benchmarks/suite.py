@@ -0,0 +1,233 @@
+from tin.parser import parser, ParsingError
+from tin.AST import VerbExpr, LiteralExpr
+from tin.tree_walk import walk
+from tin.closure_compiler import closure_compiler
+from tin.transpiler import transpiler
+from tin.compiler import compiler
+from tin.virtual_machine import Machine, load, execute
+from tin.output import output
+
+from sys import argv, version
+from io import StringIO
+from contextlib import redirect_stdout
+from unittest.mock import patch
+from time import perf_counter, strftime
+import tracemalloc
+import subprocess
+import json
+import os
+
+
+'''
+Runs the workloads in "benchmarks/workloads/" and the FizzBuzz example
+with every engine, checking that they give the same output and result.
+Parsing, compiling and executing are timed separately, taking the best
+of REPEAT runs.
+
+Instructions per second are the number of instructions the VM executes
+for a workload divided by the execution time of an engine, so engines
+are compared on the same amount of work. Peak memory is the tracemalloc
+peak of a separate execution.
+
+Results can be saved as JSON and compared with the results of another
+commit, the ratios are execution times of this run to the saved ones.
+Run from the repository root:
+    python -m benchmarks.suite [-o results.json] [-c old.json] [workload ...]
+'''
+
+
+WORKLOADS = os.path.join(os.path.dirname(__file__), 'workloads')
+
+PROGRAMS = {name[:-len('.tin')]: os.path.join(WORKLOADS, name)
+            for name in sorted(os.listdir(WORKLOADS)) if name.endswith('.tin')}
+PROGRAMS['FizzBuzz'] = os.path.join(os.path.dirname(os.path.dirname(__file__)),
+                                     'examples', 'FizzBuzz.tin')
+
+# Workloads reading input, with what they get
+INPUTS = {'FizzBuzz': '300\n'}
+
+REPEAT = 3
+
+USAGE = 'Usage: python -m benchmarks.suite [-o results.json] [-c old.json] [workload ...]'
+
+
+####   Engines   ####
+
+'''
+Every engine is a pair of functions:
+compile: ast -> code, None if the engine runs the AST itself
+run: code -> result
+'''
+
+def run_walk(ast):
+    return walk(VerbExpr('pali', LiteralExpr(ast), [LiteralExpr({})]))
+
+
+def compile_python(ast):
+    return compile(transpiler(ast), '<tin>', 'exec')
+
+
+def run_python(code):
+    namespace = {}
+    exec(code, namespace)
+    return namespace['main']({})
+
+
+def run_vm(compiled):
+    return execute(Machine(load(compiled), []))
+
+
+ENGINES = {
+    'walk'    : (None, run_walk),
+    'closures': (closure_compiler, lambda compiled: compiled({})),
+    'python'  : (compile_python, run_python),
+    'vm'      : (compiler, run_vm),
+}
+
+
+####   Measurements   ####
+
+def quietly(function, stdin):
+    '''
+    Calls function with the given stdin, returns its result and output.
+    '''
+    out = StringIO()
+    with redirect_stdout(out), patch('sys.stdin', StringIO(stdin)):
+        ans = function()
+    return ans, out.getvalue()
+
+
+def best_time(function, stdin):
+    '''
+    Returns the best time of REPEAT calls and the result and output.
+    '''
+    times = []
+    for _ in range(REPEAT):
+        start = perf_counter()
+        ans = quietly(function, stdin)
+        times.append(perf_counter() - start)
+    return min(times), ans
+
+
+def peak_memory(function, stdin) -> int:
+    tracemalloc.start()
+    try:
+        quietly(function, stdin)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak
+
+
+def count_instructions(compiled, stdin) -> int:
+    vm = Machine(load(compiled), [])
+    steps = 0
+    def count():
+        nonlocal steps
+        while True:
+            handler, operand = vm.code[vm.ip]
+            vm.ip += 1
+            steps += 1
+            if handler(vm, operand):
+                output.flush()
+                return
+    quietly(count, stdin)
+    return steps
+
+
+def measure(name, path):
+    with open(path, 'r') as f:
+        source = f.read()
+    stdin = INPUTS.get(name, '')
+    parse_time, (ast, _) = best_time(lambda: parser(source), '')
+    assert not isinstance(ast, ParsingError), str(ast)
+    instructions = count_instructions(compiler(ast), stdin)
+    results = []
+    expected = None
+    for engine, (compile_code, run) in ENGINES.items():
+        if compile_code is None:
+            compile_time = None
+            running = lambda: run(ast)
+        else:
+            compile_time, (code, _) = best_time(lambda: compile_code(ast), '')
+            running = lambda: run(code)
+        execute_time, ans = best_time(running, stdin)
+        if expected is None:
+            expected = ans
+        assert ans == expected, (name, engine)
+        results.append({
+            'workload': name,
+            'engine': engine,
+            'parse': parse_time,
+            'compile': compile_time,
+            'execute': execute_time,
+            'instructions': instructions,
+            'instructions_per_second': instructions / execute_time,
+            'peak_memory': peak_memory(running, stdin),
+        })
+    return results
+
+
+def commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+####   Reports   ####
+
+def row(result, baseline):
+    compile_time = result['compile']
+    compile_ms = '-' if compile_time is None else f'{compile_time * 1e3:.1f}'
+    line = (f'{result["workload"]:>14} {result["engine"]:>9} '
+            f'{result["parse"] * 1e3:>9.1f} {compile_ms:>9} '
+            f'{result["execute"] * 1e3:>10.1f} '
+            f'{result["instructions_per_second"] / 1e6:>8.2f} '
+            f'{result["peak_memory"] / 1024:>9.0f}')
+    old = baseline.get((result['workload'], result['engine']))
+    if old is not None:
+        line += f' {result["execute"] / old["execute"]:>7.2f}'
+    return line
+
+
+def main(args):
+    json_path = None
+    baseline = {}
+    names = []
+    while args:
+        match args:
+            case ['-o', str() as json_path, *args]:
+                pass
+            case ['-c', str() as path, *args]:
+                with open(path, 'r') as f:
+                    baseline = {(r['workload'], r['engine']): r
+                                for r in json.load(f)['results']}
+            case [str() as name, *args] if name in PROGRAMS:
+                names.append(name)
+            case ['-o' | '-c' as option]:
+                print(f'Option {option} requires a path.\n{USAGE}')
+                return
+            case [str() as arg, *_]:
+                problem = 'option' if arg.startswith('-') else 'workload'
+                print(f'Unknown {problem} {arg!r}.\n{USAGE}\n'
+                      f'Workloads: {", ".join(PROGRAMS)}')
+                return
+    names = names or list(PROGRAMS)
+    print(f'{"workload":>14} {"engine":>9} {"parse ms":>9} {"compile ms":>9} '
+          f'{"execute ms":>10} {"M ins/s":>8} {"peak KiB":>9}' +
+          (f' {"ratio":>7}' if baseline else ''))
+    results = []
+    for name in names:
+        for result in measure(name, PROGRAMS[name]):
+            print(row(result, baseline))
+            results.append(result)
+    if json_path is not None:
+        with open(json_path, 'w') as f:
+            json.dump({'commit': commit(), 'date': strftime('%Y-%m-%dT%H:%M:%S'),
+                       'python': version, 'results': results}, f, indent=1)
+
+
+if __name__ == '__main__':
+    main(argv[1:])
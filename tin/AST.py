@@ -105,10 +105,14 @@ class TableAssignment:
 
 class Sentence:
 
-    def __init__(self, conditions, assignment, expr):
+    # line and column of the first token in the source, counted from 0,
+    # None for sentences which aren't in the source
+    def __init__(self, conditions, assignment, expr, line=None, column=None):
         self.conditions = conditions
         self.assignment = assignment
         self.expr = expr
+        self.line = line
+        self.column = column
 
     def __str__(self):
         conds = ''
@@ -123,9 +127,11 @@ class Sentence:
 
 class Paragraph:
 
-    def __init__(self, arguments, sentences):
+    def __init__(self, arguments, sentences, line=None, column=None):
         self.arguments = arguments
         self.sentences = sentences
+        self.line = line
+        self.column = column
 
     def __str__(self):
         if self.arguments:
@@ -0,0 +1,108 @@
+from .compiler import VERSION
+from hashlib import sha256
+import os
+
+
+'''
+A directory of compiled bytecode, so running an unchanged source
+again skips the parser and the compiler.
+
+Entries are named after a hash of the source together with the
+bytecode version, the code of the modules producing the bytecode and
+a variant string describing the options it was compiled with.
+Changing any of them makes old entries unreachable. Those are removed
+by the LRU eviction which keeps the directory under a size limit,
+using modification times as last access times.
+'''
+
+
+MAX_SIZE = 64 * 1024 * 1024
+
+# Modules whose changes change the compiled bytecode
+COMPILER_MODULES = ['AST.py', 'parser.py', 'optimizer.py', 'compiler.py']
+
+
+def default_directory() -> str:
+    base = os.environ.get('XDG_CACHE_HOME') or \
+           os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'tin')
+
+
+def compiler_hash() -> bytes:
+    h = sha256(bytes((VERSION,)))
+    here = os.path.dirname(os.path.abspath(__file__))
+    for name in COMPILER_MODULES:
+        with open(os.path.join(here, name), 'rb') as f:
+            h.update(f.read())
+    return h.digest()
+
+
+def entry(directory: str, source: str, variant: str) -> str:
+    h = sha256(compiler_hash())
+    h.update(variant.encode('utf-8') + b'\0')
+    h.update(source.encode('utf-8'))
+    return os.path.join(directory, h.hexdigest() + '.til')
+
+
+def lookup(directory: str, source: str, variant: str = '') -> bytes | None:
+    '''
+    Returns the bytecode cached for the given source,
+    None if there is none.
+    '''
+    path = entry(directory, source, variant)
+    try:
+        with open(path, 'rb') as f:
+            compiled = f.read()
+        os.utime(path)
+    except OSError:
+        return None
+    if not compiled or compiled[0] != VERSION:
+        return None
+    return compiled
+
+
+def store(directory: str, source: str, compiled: bytes,
+          variant: str = '', max_size: int = MAX_SIZE):
+    '''
+    Caches the bytecode compiled from the given source.
+    Failing to write the cache is not an error.
+    '''
+    path = entry(directory, source, variant)
+    # Written aside and renamed, so concurrent runs never read half a file
+    temp = f'{path}.{os.getpid()}'
+    try:
+        os.makedirs(directory, exist_ok=True)
+        with open(temp, 'wb') as f:
+            f.write(compiled)
+        os.replace(temp, path)
+        evict(directory, max_size)
+    except OSError:
+        # Not a .til file, so eviction would never remove it
+        try:
+            os.remove(temp)
+        except OSError:
+            pass
+
+
+def evict(directory: str, max_size: int):
+    '''
+    Removes the least recently used entries
+    until the directory fits in max_size bytes.
+    '''
+    entries = []
+    for e in os.scandir(directory):
+        if e.name.endswith('.til'):
+            try:
+                stat = e.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, e.path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_size:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total -= size
@@ -0,0 +1,413 @@
+from .AST import *
+from .environment import Environment
+from .output import output
+from .input import readline, reading
+from .rope import Rope, STRINGS, concat
+from random import randrange
+from io import TextIOWrapper
+
+
+'''
+Compiles the AST into nested python closures.
+
+Every expression becomes a function of type:
+env -> value
+and every sentence becomes a function of type:
+env -> None | (RETURN, value) | (Procedure, env, assign, tail)
+
+All decisions based on node types, operators and verbs are made once,
+at compile time. Calls are executed on an explicit stack the same way
+as in tree_walk, so deep recursion doesn't reach the python stack.
+'''
+
+
+RETURN = object()
+
+
+class Procedure:
+
+    def __init__(self, arguments):
+        self.arguments = arguments
+        self.sentences = []
+
+
+def represent(val):
+    match val:
+        case True:
+            return '[lon]'
+        case False:
+            return '[lon ala]'
+        case int():
+            return '[nanpa]'
+        case str():
+            return val
+        case Rope():
+            return str(val)
+        case Procedure():
+            return '[pali]'
+        case dict():
+            return '[kulupu]'
+        case TextIOWrapper():
+            return '[lipu]'
+        case None:
+            return '[ala]'
+        case a:
+            raise ValueError(a)
+
+
+####   Expressions   ####
+
+def constant(value):
+    def f(env):
+        return value
+    return f
+
+
+def table(env):
+    return {}
+
+
+def random(env):
+    return randrange(256)
+
+
+def compile_add(left, right):
+    def f(env):
+        a = left(env)
+        b = right(env)
+        if type(a) is int and type(b) is int:
+            return a + b
+        if type(a) in STRINGS and type(b) in STRINGS:
+            return concat(a, b)
+        return None
+    return f
+
+
+def compile_pi(left, right):
+    def f(env):
+        a = left(env)
+        b = right(env)
+        if type(a) is dict:
+            if b in a:
+                return a[b]
+            return None
+        if type(a) in STRINGS and type(b) is int and 0 <= b < len(a):
+            return a[b]
+        return None
+    return f
+
+
+def compile_equal(left, right):
+    def f(env):
+        return left(env) == right(env)
+    return f
+
+
+def compile_negate(expr):
+    def f(env):
+        a = expr(env)
+        if type(a) is bool:
+            return not a
+        if type(a) is int:
+            return -a
+        return None
+    return f
+
+
+def compile_smaller(expr):
+    def f(env):
+        a = expr(env)
+        return type(a) is int and a < 0
+    return f
+
+
+def compile_bigger(expr):
+    def f(env):
+        a = expr(env)
+        return type(a) is int and a > 0
+    return f
+
+
+def clamp(n, length):
+    return min(max(n, 0), length)
+
+
+def compile_kipisi(first, start, stop):
+    def f(env):
+        s, a, b = first(env), start(env), stop(env)
+        if type(s) not in STRINGS:
+            return None
+        a = clamp(a, len(s)) if type(a) is int else 0
+        b = clamp(b, len(s)) if type(b) is int else len(s)
+        return s[a:b]
+    return f
+
+
+def compile_lukin(first):
+    def f(env):
+        source = first(env)
+        output.flush()
+        if isinstance(source, TextIOWrapper) and not source.closed \
+           and source.readable():
+            return source.readline()
+        return readline()
+    return f
+
+
+def compile_sitelen(first, dest):
+    def f(env):
+        file = dest(env)
+        value = represent(first(env))
+        if isinstance(file, TextIOWrapper) and not file.closed \
+           and file.writable():
+            output.write(value, file)
+        else:
+            output.write(value)
+    return f
+
+
+def compile_open(first, mode):
+    def f(env):
+        name = first(env)
+        if type(name) not in STRINGS:
+            return None
+        try:
+            return open(str(name), 'w' if mode(env) == 'sitelen' else 'r')
+        except Exception:
+            return None
+    return f
+
+
+def compile_pini(first):
+    def f(env):
+        file = first(env)
+        if isinstance(file, TextIOWrapper) and not file.closed:
+            output.close(file)
+    return f
+
+
+def compile_expression(expr, procedures, pali_ni):
+    '''Compiles any expression other than a pana or pali verb.'''
+    def sub(e):
+        return compile_expression(e, procedures, pali_ni)
+    match expr:
+        case LiteralExpr(value=Paragraph() as par):
+            return constant(compile_paragraph(par, procedures))
+        case LiteralExpr(value=dict()):
+            return table
+        case LiteralExpr(value=value):
+            return constant(value)
+        case VariableExpr(var_type='lili', identifier=k):
+            return lambda env: env.get_local(k)
+        case VariableExpr(var_type='suli', identifier=k):
+            return lambda env: env.get_global(k)
+        case VariableExpr(identifier=k):
+            return lambda env: env.get_first(k)
+        case RandomExpr():
+            return random
+        case RecursiveExpr():
+            return constant(pali_ni)
+        case NegateExpr(expr=e):
+            return compile_negate(sub(e))
+        case BinExpr(op='li', left=left, right=right):
+            return compile_equal(sub(left), sub(right))
+        case BinExpr(op='en', left=left, right=right):
+            return compile_add(sub(left), sub(right))
+        case BinExpr(op='pi', left=left, right=right):
+            return compile_pi(sub(left), sub(right))
+        case ComparisonExpr(op='lili', expr=e):
+            return compile_smaller(sub(e))
+        case ComparisonExpr(op='suli', expr=e):
+            return compile_bigger(sub(e))
+        case VerbExpr(verb=verb, first=first, args=args):
+            args = [sub(arg) for arg in args] + [constant(None)] * 2
+            first = sub(first)
+            match verb:
+                case 'lukin':
+                    return compile_lukin(first)
+                case 'sitelen':
+                    return compile_sitelen(first, args[0])
+                case 'kipisi':
+                    return compile_kipisi(first, args[0], args[1])
+                case 'open':
+                    return compile_open(first, args[0])
+                case 'pini':
+                    return compile_pini(first)
+        case None:
+            return constant(None)
+    raise ValueError(expr)
+
+
+####   Sentences   ####
+
+def compile_assignment(assignment, procedures, pali_ni):
+    '''
+    Returns a function of type:
+    env -> None | (value -> None)
+    which resolves the assigned place before the value is computed.
+    '''
+    match assignment:
+        case None:
+            return constant(None)
+        case VariableExpr(var_type='lili', identifier=k):
+            return lambda env: lambda v: env.set_local(k, v)
+        case VariableExpr(var_type='suli', identifier=k):
+            return lambda env: lambda v: env.set_global(k, v)
+        case VariableExpr(identifier=k):
+            return lambda env: lambda v: env.set_first(k, v)
+        case TableAssignment(table=t, index=i):
+            t = compile_expression(t, procedures, pali_ni)
+            i = compile_expression(i, procedures, pali_ni)
+            def f(env):
+                target = t(env)
+                if type(target) is dict:
+                    return setter(target, i(env))
+                return None
+            return f
+    raise ValueError(assignment)
+
+
+def setter(target, index):
+    def f(v):
+        target[index] = v
+    return f
+
+
+def compile_call(first, args, assign, tail):
+    def f(env):
+        place = assign(env)
+        p = first(env)
+        if type(p) is not Procedure:
+            if place is not None:
+                place(None)
+            return None
+        new_env = env.tail() if tail else Environment(env)
+        params = p.arguments
+        for n, k in enumerate(params):
+            new_env.set_local(k, args[n](env) if n < len(args) else None)
+        return p, new_env, place, tail
+    return f
+
+
+def compile_store(assignment, expr, assign):
+    match assignment:
+        case None:
+            def body(env):
+                expr(env)
+        case VariableExpr(var_type='lili', identifier=k):
+            def body(env):
+                env.set_local(k, expr(env))
+        case VariableExpr(var_type='suli', identifier=k):
+            def body(env):
+                env.set_global(k, expr(env))
+        case VariableExpr(identifier=k):
+            def body(env):
+                env.set_first(k, expr(env))
+        case _:
+            def body(env):
+                place = assign(env)
+                value = expr(env)
+                if place is not None:
+                    place(value)
+    return body
+
+
+def compile_sentence(sentence, procedures, pali_ni, last):
+    def sub(e):
+        return compile_expression(e, procedures, pali_ni)
+    assign = compile_assignment(sentence.assignment, procedures, pali_ni)
+    match sentence.expr:
+        case VerbExpr(verb='pana', first=first):
+            first = sub(first)
+            def body(env):
+                assign(env)
+                return RETURN, first(env)
+        case VerbExpr(verb='pali', first=first, args=args):
+            tail = last and sentence.assignment is None
+            body = compile_call(sub(first), [sub(arg) for arg in args],
+                                assign, tail)
+        case expr:
+            body = compile_store(sentence.assignment, sub(expr), assign)
+    conditions = [sub(cond) for cond in sentence.conditions]
+    if not conditions:
+        return body
+    def f(env):
+        for cond in conditions:
+            val = cond(env)
+            if val is None or val is False:
+                return None
+        return body(env)
+    return f
+
+
+def compile_paragraph(par, procedures):
+    if par in procedures:
+        return procedures[par]
+    procedure = Procedure([arg.identifier for arg in par.arguments])
+    procedures[par] = procedure
+    procedure.sentences = [
+        compile_sentence(s, procedures, procedure, n == len(par.sentences))
+        for n, s in enumerate(par.sentences, 1)
+    ]
+    return procedure
+
+
+####   Execution   ####
+
+class Frame:
+
+    def __init__(self, procedure, env, assign=None):
+        self.sentences = procedure.sentences
+        self.env = env
+        self.i = 0
+        self.assign = assign
+        self.void = False
+
+
+def execute(frame):
+    stack = []
+    while True:
+        sentences = frame.sentences
+        if frame.i == len(sentences):
+            value = None
+        else:
+            action = sentences[frame.i](frame.env)
+            frame.i += 1
+            if action is None:
+                continue
+            if action[0] is not RETURN:
+                p, env, assign, tail = action
+                if tail:
+                    frame.sentences, frame.env, frame.i = p.sentences, env, 0
+                    frame.void = True
+                else:
+                    stack.append(frame)
+                    frame = Frame(p, env, assign)
+                continue
+            value = action[1]
+        if frame.void:
+            value = None
+        if frame.assign is not None:
+            frame.assign(value)
+        if not stack:
+            return value
+        frame = stack.pop()
+
+
+def closure_compiler(ast: Paragraph):
+    '''
+    Returns a python function running the given program
+    with the given arguments. lukin reads from the stream
+    given as stdin, if any.
+    '''
+    procedure = compile_paragraph(ast, {})
+    def program(*args, stdin=None):
+        env = Environment(Environment())
+        for n, k in enumerate(procedure.arguments):
+            env.set_local(k, args[n] if n < len(args) else None)
+        try:
+            with reading(stdin):
+                return execute(Frame(procedure, env))
+        finally:
+            output.flush()
+    return program
@@ -2,8 +2,22 @@ from .AST import *
 
 
 '''
-Compatible with til bytecode version 0.
+Compatible with til bytecode version 2.
 For more info see the docs folder.
+
+Every operand has the same width in bytes, the smallest one which
+fits every operand of the program. String literals and numbers too
+big for an operand are stored in a constant pool.
+
+Optionally a debug table with the source position of every
+sentence is included, for profilers.
+
+Variables which are only ever used as ijo lili can't be reached
+by dynamic scoping from other frames, so they are resolved to slots
+of a frame instead of being looked up by name.
+
+Common sequences of instructions are prefixed with a superinstruction
+opcode which the VM executes as a single instruction.
 '''
 
 VARIABLE = {
@@ -33,13 +47,39 @@ OPCODE = {
     'pini'   : 54,
 }
 
+TAIL_CALL = 55
+
+GET_SLOT = 20
+SET_SLOT = 21
+
+# Followed by a count, replaces that many additions of a variable
+SCALE = 24
+MAX_SCALE = 255
+
+# Superinstructions, followed by the instructions they replace
+# without the last opcode, see docs/bytecode.txt
+LOAD_PI = 25
+LOAD_ADD = 26
+LOAD_SUBTRACT = 27
+LOAD_JEZ = 28
+ASSIGN_EMPTY = 29
+
+VERSION = 2
+
 
 INT = 0b00000000
-STR = 0b00001000
+CONST = 0b00001000
 JMP = 0b00010000
 JEZ = 0b00011000
 COMMAND = 0b10000000
 
+# Types of constants in the constant pool
+CONST_INT = 0
+CONST_STR = 1
+
+# Header flags
+DEBUG_TABLE = 0b00000001
+
 
 # big-endian
 def int_to_bytes(n):
@@ -50,13 +90,91 @@ def int_to_bytes(n):
     return bytearray(reversed(encoded))
 
 
-def get_var_len(dictionary):
-    var_len = 0
-    n = len(dictionary)
-    while n:
-        var_len += 1
-        n //= 256
-    return var_len
+class Constants:
+    '''
+    The constant pool of a program, numbering its constants
+    in the order they are first used.
+    '''
+
+    def __init__(self):
+        self.indices = {}
+
+    def index(self, value):
+        # Keyed by type as well, so 1 and '1' stay apart
+        key = (type(value), value)
+        if key not in self.indices:
+            self.indices[key] = len(self.indices)
+        return self.indices[key]
+
+    def encode(self):
+        '''
+        Returns the addresses of the constants and their end
+        together with the encoded constants.
+        '''
+        addresses = []
+        pool = bytearray()
+        for kind, value in self.indices:
+            addresses.append(len(pool))
+            if kind is int:
+                pool.append(CONST_INT)
+                pool += int_to_bytes(value)
+            else:
+                pool.append(CONST_STR)
+                pool += value.encode('utf-8')
+        addresses.append(len(pool))
+        return addresses, pool
+
+
+def encode_literal(value, width, constants):
+    '''
+    Encodes a literal number or string, numbers fitting
+    in an operand are stored in the instruction.
+    '''
+    if type(value) is int and 0 <= value < 256 ** width:
+        return bytes((INT,)) + value.to_bytes(width, 'big')
+    return bytes((CONST,)) + constants.index(value).to_bytes(width, 'big')
+
+
+def encode_debug_table(positions) -> bytearray:
+    '''
+    Encodes lists of (address, line, column) for every paragraph.
+    '''
+    numbers = [n for par in positions for position in par for n in position]
+    width = max((len(int_to_bytes(n)) for n in numbers + [len(positions)]),
+                default=1)
+    table = bytearray((width,))
+    for par in positions:
+        table += len(par).to_bytes(width, 'big')
+        for position in par:
+            for n in position:
+                table += n.to_bytes(width, 'big')
+    return table
+
+
+def assemble(width, addresses, compiled, constants,
+             positions=None) -> bytearray:
+    '''
+    Prepends the header, paragraph table, constant pool
+    and optionally the debug table to the compiled paragraphs.
+    '''
+    const_addresses, pool = constants.encode()
+    debug = bytearray()
+    if positions is not None:
+        debug = encode_debug_table(positions)
+    # Tables aren't instructions, so they get their own width
+    adr_len = max(len(int_to_bytes(len(compiled))),
+                  len(int_to_bytes(len(pool))),
+                  len(int_to_bytes(len(debug))), 1)
+    flags = 0 if positions is None else DEBUG_TABLE
+    header = bytearray((VERSION, width, adr_len, flags))
+    for n in [len(addresses), len(const_addresses) - 1,
+              *addresses, *const_addresses]:
+        header += n.to_bytes(adr_len, 'big')
+    header += pool
+    if positions is not None:
+        header += len(debug).to_bytes(adr_len, 'big')
+        header += debug
+    return header + compiled
 
 
 class Dictionary:
@@ -64,6 +182,47 @@ class Dictionary:
     def __init__(self):
         self.vars = {}
         self.pars = {}
+        # Every way each variable is used in the program
+        self.uses = {}
+        # Variables resolved to frame slots
+        self.locals = None
+        # Encoded slots of the paragraph being compiled
+        self.slots = {}
+        # Source positions of the sentences of the paragraph being
+        # compiled, None when not compiling a debug table
+        self.positions = None
+        # Operand width, encoded identifiers and constants,
+        # set by encode once the dictionary is complete
+        self.width = None
+        self.var_codes = None
+        self.par_codes = None
+        self.constants = None
+
+    def encode(self, width):
+        '''
+        Raises OverflowError if the identifiers don't fit in width bytes.
+        '''
+        self.width = width
+        self.var_codes = {k: v.to_bytes(width, 'big')
+                          for k, v in self.vars.items()}
+        self.par_codes = {k: v.to_bytes(width, 'big')
+                          for k, v in self.pars.items()}
+        self.constants = Constants()
+        self.locals = {k for k, v in self.uses.items() if v == {'lili'}}
+
+    def operand(self, n):
+        return n.to_bytes(self.width, 'big')
+
+    def slot(self, identifier):
+        if identifier not in self.slots:
+            self.slots[identifier] = self.operand(len(self.slots))
+        return self.slots[identifier]
+
+
+def add_variable(dictionary, identifier, var_type):
+    if identifier not in dictionary.vars:
+        dictionary.vars[identifier] = len(dictionary.vars)
+    dictionary.uses.setdefault(identifier, set()).add(var_type)
 
 
 def make_dictionary(ast, dictionary=None):
@@ -74,9 +233,8 @@ def make_dictionary(ast, dictionary=None):
             make_dictionary(par, dictionary)
         case LiteralExpr():
             pass
-        case VariableExpr(identifier = identifier):
-            if identifier not in dictionary.vars:
-                dictionary.vars[identifier] = len(dictionary.vars)
+        case VariableExpr(var_type = var_type, identifier = identifier):
+            add_variable(dictionary, identifier, var_type)
         case RandomExpr():
             pass
         case RecursiveExpr():
@@ -104,7 +262,7 @@ def make_dictionary(ast, dictionary=None):
         case Paragraph(arguments = arguments, sentences = sentences):
             dictionary.pars[ast] = len(dictionary.pars)
             for arg in arguments:
-                make_dictionary(arg, dictionary)
+                add_variable(dictionary, arg.identifier, 'lili')
             for expr in sentences:
                 make_dictionary(expr, dictionary)
         case a:
@@ -112,134 +270,235 @@ def make_dictionary(ast, dictionary=None):
     return dictionary
 
 
-def compile_ast(ast, dictionary) -> bytearray:
+def is_tail_call(sentence):
+    '''
+    A sentence is a tail call when it's the last one in a paragraph and
+    it calls a paragraph without assigning the result. Only the implicit
+    pana follows it, so the caller's frame is not needed anymore.
+    '''
+    match sentence:
+        case Sentence(assignment=None, expr=VerbExpr(verb='pali')):
+            return True
+    return False
+
+
+def sum_operands(expr):
+    match expr:
+        case BinExpr(op = 'en', left = left, right = right):
+            return sum_operands(left) + [right]
+    return [expr]
+
+
+def same_variable(a, b):
+    match a, b:
+        case VariableExpr(), VariableExpr():
+            return a.var_type == b.var_type and a.identifier == b.identifier
+    return False
+
+
+def is_int_literal(expr):
+    match expr:
+        case LiteralExpr(value = int() as value) if type(value) is not bool:
+            return True
+    return False
+
+
+def is_key_literal(expr):
+    match expr:
+        case LiteralExpr(value = str()):
+            return True
+    return is_int_literal(expr)
+
+
+def compile_sum(operands, dictionary, out):
+    '''
+    Compiles a chain of en. Tin has no multiplication so a variable
+    added to itself n times is compiled to a single scale by n.
+    Adding is associative (anything other than two numbers or two
+    strings gives ala, which stays ala) and reading a variable has no
+    side effects, so this gives the same result as adding one by one.
+    '''
+    groups = []
+    for operand in operands:
+        if groups and groups[-1][1] < MAX_SCALE and \
+           same_variable(groups[-1][0], operand):
+            groups[-1][1] += 1
+        else:
+            groups.append([operand, 1])
+    match groups:
+        case [[VariableExpr() as var, 1], [LiteralExpr() as n, 1], *_] \
+             if is_int_literal(n):
+            out.append(LOAD_ADD + COMMAND)
+            compile_ast(var, dictionary, out)
+            compile_ast(n, dictionary, out)
+            groups = groups[2:]
+        case [[VariableExpr() as var, 1], [NegateExpr(expr = n), 1], *_] \
+             if is_int_literal(n):
+            out.append(LOAD_SUBTRACT + COMMAND)
+            compile_ast(var, dictionary, out)
+            compile_ast(n, dictionary, out)
+            groups = groups[2:]
+        case [[first, count], *groups]:
+            compile_ast(first, dictionary, out)
+            if count > 1:
+                out.append(SCALE + COMMAND)
+                out += dictionary.operand(count)
+    for operand, count in groups:
+        compile_ast(operand, dictionary, out)
+        if count > 1:
+            out.append(SCALE + COMMAND)
+            out += dictionary.operand(count)
+        out.append(OPCODE['en'] + COMMAND)
+
+
+def compile_ast(ast, dictionary, out, tail=False):
+    '''
+    Appends the bytecode of ast to out.
+    '''
     match ast:
         case LiteralExpr(value = True):
-            return bytearray((0 + COMMAND,))
+            out.append(0 + COMMAND)
         case LiteralExpr(value = dict()):
-            return bytearray((1 + COMMAND,))
+            out.append(1 + COMMAND)
         case LiteralExpr(value = None):
-            return bytearray((2 + COMMAND,))
-        case LiteralExpr(value = str() as s):
-            s = bytearray(s, 'utf-8')
-            encoded = int_to_bytes(len(s))
-            assert len(encoded) <= 7
-            return bytearray((len(encoded) + STR,)) + encoded + s
-        case LiteralExpr(value = int() as i) if type(i) is not bool:
-            encoded = int_to_bytes(i)
-            assert len(encoded) <= 7
-            return bytearray((len(encoded) + INT,)) + encoded
+            out.append(2 + COMMAND)
+        case LiteralExpr(value = str() | int() as value) \
+             if type(value) is not bool:
+            out += encode_literal(value, dictionary.width, dictionary.constants)
         case LiteralExpr(value = Paragraph() as par):
-            par_len = get_var_len(dictionary.pars)
-            par = dictionary.pars[par]
-            encoded = int_to_bytes(par)
-            assert len(encoded) <= par_len
-            compiled = bytearray((3 + COMMAND,))
-            compiled += bytearray(par_len - len(encoded)) + encoded
-            return compiled
+            out.append(3 + COMMAND)
+            out += dictionary.par_codes[par]
+        case VariableExpr(var_type='lili', identifier=identifier) \
+             if identifier in dictionary.locals:
+            out.append(GET_SLOT + COMMAND)
+            out += dictionary.slot(identifier)
         case VariableExpr(var_type=var_type, identifier=identifier):
-            compiled = bytearray((VARIABLE[var_type] + COMMAND,))
-            identifier = dictionary.vars[identifier]
-            var_len = get_var_len(dictionary.vars)
-            encoded = int_to_bytes(identifier)
-            assert len(encoded) <= var_len
-            compiled += bytearray(var_len - len(encoded)) + encoded
-            return compiled
+            out.append(VARIABLE[var_type] + COMMAND)
+            out += dictionary.var_codes[identifier]
         case RandomExpr():
-            return bytearray((8 + COMMAND,))
+            out.append(8 + COMMAND)
         case RecursiveExpr():
-            return bytearray((9 + COMMAND,))
+            out.append(9 + COMMAND)
         case NegateExpr(expr = expr):
-            return compile_ast(expr, dictionary) + bytearray((13 + COMMAND,))
+            compile_ast(expr, dictionary, out)
+            out.append(13 + COMMAND)
+        case BinExpr(op = 'en'):
+            compile_sum(sum_operands(ast), dictionary, out)
+        case BinExpr(op = 'pi', left = VariableExpr() as left, right = right) \
+             if is_key_literal(right):
+            out.append(LOAD_PI + COMMAND)
+            compile_ast(left, dictionary, out)
+            compile_ast(right, dictionary, out)
         case BinExpr(left = left, right = right, op = op):
-            compiled = compile_ast(left, dictionary)
-            compiled += compile_ast(right, dictionary)
-            return compiled + bytearray((OPCODE[op] + COMMAND,))
+            compile_ast(left, dictionary, out)
+            compile_ast(right, dictionary, out)
+            out.append(OPCODE[op] + COMMAND)
         case ComparisonExpr(op = op, expr = expr):
-            compiled = compile_ast(expr, dictionary)
-            return compiled + bytearray((OPCODE[op] + COMMAND,))
+            compile_ast(expr, dictionary, out)
+            out.append(OPCODE[op] + COMMAND)
         case VerbExpr(verb = verb, first = first, args = args):
-            compiled = bytearray()
             for arg in args[::-1]:
-                compiled += compile_ast(arg, dictionary)
+                compile_ast(arg, dictionary, out)
             if first is not None:
-                compiled += compile_ast(first, dictionary)
+                compile_ast(first, dictionary, out)
             else:
-                compiled.append(2 + COMMAND)
-            return compiled + bytearray((OPCODE[verb] + COMMAND,))
+                out.append(2 + COMMAND)
+            out.append(OPCODE[verb] + COMMAND)
         case TableAssignment(table = table, index = index):
-            compiled = compile_ast(table, dictionary)
-            compiled += compile_ast(index, dictionary)
-            return compiled + bytearray((16 + COMMAND,))
+            compile_ast(table, dictionary, out)
+            compile_ast(index, dictionary, out)
+            out.append(16 + COMMAND)
         case Sentence(conditions = conditions, assignment = assignment, expr = expr):
-            compiled_conds = []
+            if dictionary.positions is not None and ast.line is not None:
+                dictionary.positions.append((len(out), ast.line, ast.column))
+            # Every condition is followed by a jump with a placeholder
+            # offset, patched once the length of the rest is known.
+            jumps = []
             for cond in conditions:
-                compiled_conds.append(compile_ast(cond, dictionary))
-            compiled = compile_ast(expr, dictionary)
+                if isinstance(cond, VariableExpr):
+                    out.append(LOAD_JEZ + COMMAND)
+                compile_ast(cond, dictionary, out)
+                out.append(JEZ)
+                jumps.append(len(out))
+                out += dictionary.operand(0)
+            compile_ast(expr, dictionary, out)
             match assignment:
                 case TableAssignment():
-                    compiled += compile_ast(assignment, dictionary)
+                    compile_ast(assignment, dictionary, out)
+                case VariableExpr(var_type = 'lili', identifier = identifier) \
+                     if identifier in dictionary.locals:
+                    out.append(SET_SLOT + COMMAND)
+                    out += dictionary.slot(identifier)
                 case VariableExpr(var_type = var_type, identifier = identifier):
-                    compiled += bytearray((ASSIGNMENT[var_type] + COMMAND,))
-                    identifier = dictionary.vars[identifier]
-                    var_len = get_var_len(dictionary.vars)
-                    encoded = int_to_bytes(identifier)
-                    assert len(encoded) <= var_len
-                    compiled += bytearray(var_len - len(encoded)) + encoded
+                    out.append(ASSIGNMENT[var_type] + COMMAND)
+                    out += dictionary.var_codes[identifier]
+                case None if tail and is_tail_call(ast):
+                    out[-1] = TAIL_CALL + COMMAND
                 case None:
-                    compiled.append(22 + COMMAND)
-            for cond in compiled_conds[::-1]:
-                jump_dist = len(compiled)
-                encoded = int_to_bytes(jump_dist)
-                assert len(encoded) <= 7
-                cond.append(len(encoded) + JEZ)
-                compiled = cond + encoded + compiled
-            return compiled
+                    out.append(22 + COMMAND)
+            width = dictionary.width
+            for jump in jumps:
+                out[jump:jump + width] = \
+                    dictionary.operand(len(out) - jump - width)
         case Paragraph(arguments = arguments, sentences = sentences):
-            compiled = bytearray()
-            for arg in arguments:
-                compiled += bytearray((ASSIGNMENT['lili'] + COMMAND,))
-                identifier = dictionary.vars[arg.identifier]
-                var_len = get_var_len(dictionary.vars)
-                encoded = int_to_bytes(identifier)
-                assert len(encoded) <= var_len
-                compiled += bytearray(var_len - len(encoded)) + encoded
-            compiled.append(23 + COMMAND)
-            for sentence in sentences:
-                compiled += compile_ast(sentence, dictionary)
-            compiled += compile_ast(
-                Sentence([], None, VerbExpr('pana', None, [])),
-                dictionary
-            )
-            return compiled
+            # Paragraphs are compiled one at a time, nested paragraphs
+            # are only referenced by their identifiers.
+            dictionary.slots = {}
+            if dictionary.positions is not None and ast.line is not None:
+                dictionary.positions.append((len(out), ast.line, ast.column))
+            for n, arg in enumerate(arguments, 1):
+                if n == len(arguments):
+                    # The last argument's assignment is fused with Empty
+                    out.append(ASSIGN_EMPTY + COMMAND)
+                if arg.identifier in dictionary.locals:
+                    out.append(SET_SLOT + COMMAND)
+                    out += dictionary.slot(arg.identifier)
+                else:
+                    out.append(ASSIGNMENT['lili'] + COMMAND)
+                    out += dictionary.var_codes[arg.identifier]
+            if not arguments:
+                out.append(23 + COMMAND)
+            for n, sentence in enumerate(sentences, 1):
+                compile_ast(sentence, dictionary, out, n == len(sentences))
+            compile_ast(Sentence([], None, VerbExpr('pana', None, [])),
+                        dictionary, out)
         case a:
             raise ValueError(a)
-            
-            
 
-def compiler(ast: Paragraph) -> bytearray:
-    dictionary = make_dictionary(ast)
-    var_len = get_var_len(dictionary.vars)
-    assert var_len < 256
-    par_len = max(get_var_len(dictionary.pars), 1)
-    assert par_len < 256
+
+def compile_program(dictionary, width, debug):
+    '''
+    Raises OverflowError if any operand doesn't fit in width bytes.
+    '''
+    dictionary.encode(width)
     pars = [x[1] for x in sorted([(v, k) for k, v in dictionary.pars.items()])]
     compiled = bytearray()
     addresses = []
+    positions = [] if debug else None
     for par in pars:
-        addresses.append(len(compiled))
-        compiled += compile_ast(par, dictionary)
-    adr_len = get_var_len(compiled)
-    assert adr_len < 256
-    par_table = bytearray()
-    for adr in addresses:
-        encoded = int_to_bytes(adr)
-        par_table += bytearray(adr_len - len(encoded)) + encoded
-    header = bytearray((0, var_len, adr_len, par_len))
-    encoded_par_num = int_to_bytes(len(addresses))
-##    print(par_len, len(encoded_par_num))
-    assert par_len == len(encoded_par_num)
-    return header + \
-           encoded_par_num + \
-           par_table + \
-           compiled
+        start = len(compiled)
+        addresses.append(start)
+        if debug:
+            dictionary.positions = []
+        compile_ast(par, dictionary, compiled)
+        if debug:
+            positions.append([(address - start, line, column)
+                              for address, line, column
+                              in dictionary.positions])
+    return assemble(width, addresses, compiled, dictionary.constants,
+                    positions)
+
+
+def compiler(ast: Paragraph, debug: bool = False) -> bytearray:
+    '''
+    Compiles the program, with a table of source positions if debug.
+    '''
+    dictionary = make_dictionary(ast)
+    # Jump offsets and addresses depend on the width,
+    # so the smallest width that fits is found by trying.
+    width = 1
+    while True:
+        try:
+            return compile_program(dictionary, width, debug)
+        except OverflowError:
+            width += 1
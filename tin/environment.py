@@ -1,40 +1,51 @@
 class Environment:
 
+    # Frames are created on every call, so they are kept small
+    __slots__ = ('parent', 'globals', 'data', 'merged')
+
     def __init__(self, parent=None):
         self.parent = parent
+        self.data = {}
         if parent is None:
-            self.grandparent = self
+            self.globals = self.data
         else:
-            self.grandparent = parent.grandparent
-        self.data = {}
+            self.globals = parent.globals
+        self.merged = False
 
     def get_local(self, k):
-        if k in self.data:
-            return self.data[k]
-        else:
-            return None
+        return self.data.get(k)
 
     def set_local(self, k, v):
         self.data[k] = v
 
-    def get_first(self, k):
+    def find(self, k):
+        # The nearest frame containing k, or the global frame
         while k not in self.data and self.parent is not None:
             self = self.parent
-        if k in self.data:
-            return self.data[k]
-        else:
-            return None
+        return self
+
+    def get_first(self, k):
+        return self.find(k).data.get(k)
 
     def set_first(self, k, v):
-        while k not in self.data and self.parent is not None:
-            self = self.parent
-        self.data[k] = v
+        self.find(k).data[k] = v
 
     def get_global(self, k):
-        if k in self.grandparent:
-            return self.grandparent.data[k]
-        else:
-            return None
+        return self.globals.get(k)
 
     def set_global(self, k, v):
-        self.grandparent.data[k] = v
+        self.globals[k] = v
+
+    def tail(self):
+        # A frame replaced by a tail call is only reachable through its
+        # callee, so instead of chaining a new frame per call its
+        # variables are merged into a single frame above the callee.
+        # The chain length and memory stay constant in tail recursive
+        # loops. The global frame is never merged into.
+        parent = self.parent
+        if parent is not None and parent.merged:
+            parent.data.update(self.data)
+            return Environment(parent)
+        if parent is not None:
+            self.merged = True
+        return Environment(self)
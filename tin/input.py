@@ -0,0 +1,100 @@
+import sys
+from io import TextIOBase, IncrementalNewlineDecoder
+from codecs import getincrementaldecoder
+from collections import deque
+from contextlib import contextmanager
+from weakref import WeakKeyDictionary
+
+
+'''
+Buffered input of lukin, shared by all the engines.
+
+Calling input() for every lukin goes through the text layer of stdin
+one line at a time. A Reader reads the underlying binary stream in
+chunks of up to SIZE bytes instead, decodes them as UTF-8 incrementally
+(so characters split between chunks are decoded once complete),
+translates \r\n and \r to \n and splits the text into lines.
+Chunks are read with read1 where the stream has it, which returns what
+is available without waiting for a whole chunk, so reading from a
+terminal still returns every line as soon as it's entered.
+
+Like with input(), every line ends with \n, even the last one, and
+the end of the input is an empty string.
+
+Readers are kept per stream, so text read ahead by one run is still
+there for the next run reading the same stream. The stream runs read
+from is set with reading, by default it's sys.stdin as it is at the
+time of reading, so patching sys.stdin around a run still works.
+'''
+
+
+SIZE = 1 << 16
+
+
+class Reader:
+
+    def __init__(self, stream):
+        # Text streams are read through their binary buffer if they have one
+        stream = getattr(stream, 'buffer', stream)
+        if isinstance(stream, TextIOBase):
+            decoder = None
+        else:
+            decoder = getincrementaldecoder('utf-8')()
+        self.decoder = IncrementalNewlineDecoder(decoder, translate=True)
+        self.read = getattr(stream, 'read1', stream.read)
+        self.lines = deque()
+        # Text of the line being read, split between chunks
+        self.partial = []
+        self.eof = False
+
+    def fill(self):
+        chunk = self.read(SIZE)
+        if not chunk:
+            self.eof = True
+        text = self.decoder.decode(chunk, final=self.eof)
+        self.partial.append(text)
+        if '\n' in text:
+            lines = ''.join(self.partial).split('\n')
+            self.partial = [lines.pop()]
+            self.lines.extend(lines)
+
+    def readline(self) -> str:
+        lines = self.lines
+        while not lines:
+            if self.eof:
+                line = ''.join(self.partial)
+                self.partial = []
+                return line + '\n' if line else ''
+            self.fill()
+        return lines.popleft() + '\n'
+
+
+readers = WeakKeyDictionary()
+
+# The stream lukin reads from, None for sys.stdin
+stream = None
+
+
+def reader(source) -> Reader:
+    found = readers.get(source)
+    if found is None:
+        found = readers[source] = Reader(source)
+    return found
+
+
+def readline() -> str:
+    return reader(sys.stdin if stream is None else stream).readline()
+
+
+@contextmanager
+def reading(source):
+    '''
+    Makes lukin read from source, a binary or text stream,
+    within the block. None stands for sys.stdin.
+    '''
+    global stream
+    previous, stream = stream, source
+    try:
+        yield
+    finally:
+        stream = previous
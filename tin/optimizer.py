@@ -0,0 +1,150 @@
+from .AST import *
+
+
+'''
+Simplifies the AST before it's executed or compiled.
+
+Level 1 folds en and ala applied to literals into literals.
+en is associative (anything other than two numbers or two strings
+gives ala, which stays ala), so runs of literals in a chain of en
+are folded even if the chain starts with a variable.
+Level 2 also removes sentences which can never be executed: those with
+a condition which is always ala or lon ala and those following a pana
+without conditions. Conditions which always hold are dropped.
+
+Values which the bytecode can't store as literals (negative numbers and
+lon ala) are kept as negations of literals, and numbers which don't fit
+in a literal are not folded at all.
+'''
+
+
+# Marks expressions whose value isn't known before execution
+UNKNOWN = object()
+
+MAX_LITERAL = 256 ** 7
+
+
+def value_of(expr):
+    match expr:
+        case LiteralExpr(value=None | True | int() | str() as value):
+            return value
+        case NegateExpr(expr=e):
+            return negate(value_of(e))
+    return UNKNOWN
+
+
+def literal(value):
+    match value:
+        case False:
+            return NegateExpr(LiteralExpr(True))
+        case int() if type(value) is not bool and value < 0:
+            return NegateExpr(LiteralExpr(-value))
+    return LiteralExpr(value)
+
+
+def fits(value):
+    return type(value) is not int or abs(value) < MAX_LITERAL
+
+
+def negate(value):
+    match value:
+        case _ if value is UNKNOWN:
+            return UNKNOWN
+        case bool():
+            return not value
+        case int():
+            return -value
+    return None
+
+
+def add(a, b):
+    if a is UNKNOWN or b is UNKNOWN:
+        return UNKNOWN
+    if type(a) is int and type(b) is int or \
+       type(a) is str and type(b) is str:
+        return a + b
+    return None
+
+
+def fold(expr, level):
+    def sub(e):
+        return fold(e, level)
+    match expr:
+        case LiteralExpr(value=Paragraph() as par):
+            return LiteralExpr(optimize(par, level))
+        case NegateExpr(expr=e):
+            e = sub(e)
+            value = negate(value_of(e))
+            if value is not UNKNOWN and fits(value):
+                return literal(value)
+            return NegateExpr(e)
+        case BinExpr(op='en'):
+            return fold_en(expr, level)
+        case BinExpr(op=op, left=left, right=right):
+            return BinExpr(op, sub(left), sub(right))
+        case ComparisonExpr(op=op, expr=e):
+            return ComparisonExpr(op, sub(e))
+        case VerbExpr(verb=verb, first=first, args=args):
+            return VerbExpr(verb, sub(first), [sub(arg) for arg in args])
+        case TableAssignment(table=table, index=index):
+            return TableAssignment(sub(table), sub(index))
+    return expr
+
+
+def operands(expr):
+    match expr:
+        case BinExpr(op='en', left=left, right=right):
+            return operands(left) + [right]
+    return [expr]
+
+
+def fold_en(expr, level):
+    folded = []
+    for operand in operands(expr):
+        operand = fold(operand, level)
+        if folded:
+            value = add(value_of(folded[-1]), value_of(operand))
+            if value is not UNKNOWN and fits(value):
+                folded[-1] = literal(value)
+                continue
+        folded.append(operand)
+    expr = folded[0]
+    for operand in folded[1:]:
+        expr = BinExpr('en', expr, operand)
+    return expr
+
+
+def optimize_sentence(sentence, level):
+    '''
+    Returns the optimized sentence, or None if it can never be executed.
+    '''
+    conditions = []
+    for cond in sentence.conditions:
+        cond = fold(cond, level)
+        if level >= 2:
+            match value_of(cond):
+                case None | False:
+                    return None
+                case value if value is not UNKNOWN:
+                    continue
+        conditions.append(cond)
+    return Sentence(conditions,
+                    fold(sentence.assignment, level),
+                    fold(sentence.expr, level),
+                    sentence.line, sentence.column)
+
+
+def optimize(ast: Paragraph, level: int = 2) -> Paragraph:
+    if level <= 0:
+        return ast
+    sentences = []
+    for sentence in ast.sentences:
+        sentence = optimize_sentence(sentence, level)
+        if sentence is None:
+            continue
+        sentences.append(sentence)
+        match sentence:
+            case Sentence(conditions=[], expr=VerbExpr(verb='pana')) \
+                 if level >= 2:
+                break
+    return Paragraph(ast.arguments, sentences, ast.line, ast.column)
@@ -0,0 +1,61 @@
+import sys
+
+
+'''
+Buffered output of sitelen, shared by all the engines.
+
+Printing every value as soon as it's written costs a trip through the
+io stack per sitelen, which dominates programs writing many short
+strings. Written strings are collected in lists instead, one per
+destination, and each list is joined into a single write when:
+ - the pending text reaches LIMIT characters,
+ - something is read with lukin, so prompts are shown before the
+   program waits for input,
+ - a lipu is closed with pini (only that lipu's text is written),
+ - the program exits.
+
+Text for the standard output is written to sys.stdout as it is
+at the time of writing, so redirecting it around a run still works.
+'''
+
+
+LIMIT = 1 << 16
+
+
+class Output:
+
+    def __init__(self, limit: int = LIMIT):
+        self.limit = limit
+        self.stdout = []
+        # Pending strings by lipu
+        self.files = {}
+        self.size = 0
+
+    def write(self, text: str, file=None):
+        if file is None:
+            self.stdout.append(text)
+        else:
+            self.files.setdefault(file, []).append(text)
+        self.size += len(text)
+        if self.size >= self.limit:
+            self.flush()
+
+    def flush(self):
+        stdout, files = self.stdout, self.files
+        self.stdout, self.files, self.size = [], {}, 0
+        for file, pending in files.items():
+            file.write(''.join(pending))
+        if stdout:
+            sys.stdout.write(''.join(stdout))
+        sys.stdout.flush()
+
+    def close(self, file):
+        pending = self.files.pop(file, None)
+        if pending is not None:
+            text = ''.join(pending)
+            self.size -= len(text)
+            file.write(text)
+        file.close()
+
+
+output = Output()
@@ -1,4 +1,5 @@
 import re
+import gc
 from .AST import *
 
 
@@ -7,13 +8,16 @@ from .AST import *
 '''
 In this file:
     p - program string
-    i - position of the parser in the string
-    l - line number for error reporting
-    c - column number for error reporting
+    t - list of tokens of the program
+    i - index of the current token
     e - Parsing Error
-    value - value of the parsed string
+    value - value of the parsed tokens
 Parsers are functions of type:
-(p, i, l, c) -> (i, l, c, e | value)
+(t, i) -> (i, e | value)
+
+The program is first split into tokens by lex,
+which records the line and column of every token
+for error reporting.
 
 ValueError is raised in the case of an
 unexhaustive match-case.
@@ -21,6 +25,26 @@ unexhaustive match-case.
 The way some parsing is grouped into functions
 may look a bit janky. Some of it is to make
 error reporting better.
+
+Parsers are built once, when this module is imported,
+and the grammar rules only run them. Parsers referring
+to rules defined further down are built at the bottom.
+
+Parsers which don't match return the FAIL sentinel
+instead of a value and record how far into the tokens
+they got in furthest. The ParsingError shown to the
+user is only built from that record, once the whole
+parse has failed.
+
+Grammar rules are memoized: each of them is run at
+most once per token, no matter how many alternatives
+backtrack over it. The memo table is cleared at the
+start of every parse.
+
+Parsing allocates a lot of objects that live until the
+end of the parse, so the cyclic garbage collector is
+paused meanwhile. Otherwise it rescans them over and
+over and parse time grows faster than the source.
 '''
 
 
@@ -37,47 +61,86 @@ class ParsingError:
         return f'Parsing error at line {self.line+1} column {self.column+1}:\n'\
                f'{self.message}'
 
-    # A trick to make max(None, ParsingError) return ParsingError in alter
-    def __lt__(self, v):
-        return False
+
+def error(token, message):
+    return ParsingError(token.line, token.column, message)
+
+
+class Failure:
+    pass
+
+
+FAIL = Failure()
+
+
+class Furthest:
+    '''
+    The furthest token any parser failed at
+    and the message explaining that failure.
+    '''
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.i = -1
+        self.message = None
+
+
+furthest = Furthest()
+
+
+def fail(i, message):
+    if i >= furthest.i:
+        furthest.i = i
+        furthest.message = message
+    return i, FAIL
+
+
+memo = {}
+
+
+def memoize(parser):
+    def f(t, i):
+        key = (parser, i)
+        if key in memo:
+            return memo[key]
+        ans = memo[key] = parser(t, i)
+        return ans
+    return f
 
 
 def chain(*parsers):
-    def f(p, i, l, c):
+    def f(t, i):
         ans = []
         for parser in parsers:
-            match parser(p, i, l, c):
-                case i, l, c, ParsingError() as e:
-                    return i, l, c, e
-                case i, l, c, parsed:
+            match parser(t, i):
+                case i, Failure() as e:
+                    return i, e
+                case i, parsed:
                     ans.append(parsed)
-        return i, l, c, ans
+        return i, ans
     return f
 
 
 def alter(*parsers):
-    def f(p, i, l, c):
+    def f(t, i):
         for parser in parsers:
-            oi, ol, oc, oe = i, l, c, None
-            match parser(p, i, l, c):
-                case ni, nl, nc, ParsingError() as ne:
-                    oi, ol, oc, oe = max((ni, nl, nc, ne), (oi, ol, oc, oe))
-                case i, l, c, parsed:
-                    return i, l, c, parsed
-                case a:
-                    raise ValueError(a)
-        return oi, ol, oc, oe
+            ni, parsed = parser(t, i)
+            if parsed is not FAIL:
+                return ni, parsed
+        return i, FAIL
     return f
 
 
 def parse_many(parser):
-    def f(p, i, l, c):
+    def f(t, i):
         ans = []
         while True:
-            match parser(p, i, l, c):
-                case _, _, _, ParsingError():
-                    return i, l, c, ans
-                case i, l, c, value:
+            match parser(t, i):
+                case _, Failure():
+                    return i, ans
+                case i, value:
                     ans.append(value)
                 case a:
                     raise ValueError(a)
@@ -85,12 +148,12 @@ def parse_many(parser):
 
 
 def option(parser):
-    def f(p, i, l, c):
-        match parser(p, i, l, c):
-            case _, _, _, ParsingError():
-                return i, l, c, None
-            case i, l, c, val:
-                return i, l, c, val
+    def f(t, i):
+        match parser(t, i):
+            case _, Failure():
+                return i, None
+            case i, val:
+                return i, val
             case a:
                 raise ValueError(a)
     return f
@@ -98,77 +161,167 @@ def option(parser):
 
 ####   Lexing   ####
 
-def parse_char(char):
-    def f(p, i, l, c):
-        if i < len(p) and p[i] == char:
-            if char == '\n':
-                c = 0
+class Token:
+
+    def __init__(self, kind, value, line, column, spaced):
+        self.kind = kind
+        self.value = value
+        self.line = line
+        self.column = column
+        # Whether the token is preceded by whitespace
+        self.spaced = spaced
+
+    def __repr__(self):
+        return f'Token({self.kind!r}, {self.value!r}, {self.line}, {self.column})'
+
+
+# I got really annoyed by trying to make a parser for tp names.
+id_pattern = re.compile('(?:(?:[AEIOU])|(?:[JKLMNPSTW][aeiou]))(?:n?(?![aeiou]))?(?:[jklmnpstw][aeiou](?:n(?![aeiou]))?)*')
+
+
+whitespace = '\n\r\t '
+
+
+token_pattern = re.compile(
+    r'(?P<space>[\n\r\t ]+)'
+    r'|(?P<string>nimi[\n\r\t ]+")'
+    r'|(?P<word>[a-z]+)'
+    rf'|(?P<identifier>{id_pattern.pattern})'
+    r'|(?P<dot>\.)'
+    r'|(?P<char>.)',
+    re.DOTALL
+)
+
+
+string_pattern = re.compile(r'[^"\\\n]*')
+
+
+escapes = {'\\': '\\', '"': '"', 'n': '\n'}
+def lex_string(p, i, l, start):
+    '''
+    Lexes the body of a string literal starting at p[i].
+    Returns the value, the position after the closing quote, the line and
+    the start of the line, or a ParsingError in place of the value.
+    '''
+    ans = []
+    while True:
+        m = string_pattern.match(p, i)
+        ans.append(m[0])
+        i = m.end()
+        if i == len(p):
+            return ParsingError(l, i - start,
+                f'Unexpected EOF while parsing a string'), i, l, start
+        match p[i]:
+            case '"':
+                return ''.join(ans), i + 1, l, start
+            case '\n':
+                ans.append('\n')
+                i += 1
                 l += 1
-            else:
-                c += 1
-            return i + 1, l, c, char
-        return i, l, c, ParsingError(l, c, f'Expected "{char}"')
-    return f
+                start = i
+            case '\\':
+                i += 1
+                if i == len(p):
+                    return ParsingError(l, i - start,
+                        f'Unexpected EOF while parsing a string'), i, l, start
+                if p[i] not in escapes:
+                    return ParsingError(l, i - start,
+                        f'Incorrect escape sequence. Did you mean "\\\\"?'), \
+                        i, l, start
+                ans.append(escapes[p[i]])
+                i += 1
 
 
-def parse_any_char(chars):
-    parsers = [parse_char(c) for c in chars]
-    def f(p, i, l, c):
-        for parser in parsers:
-            match parser(p, i, l, c):
-                case _, _, _, ParsingError():
-                    pass
-                case parsed:
-                    return parsed
-        return i, l, c, ParsingError(l, c, f'Expected one of {repr(chars)}')
+def lex(p):
+    '''
+    Splits the program into a list of tokens ending with an eof token.
+    Token kinds are 'word', 'identifier', 'string', '.', 'char' for
+    anything unexpected and 'error' for malformed strings.
+    '''
+    tokens = []
+    i = 0
+    l = 0
+    start = 0
+    spaced = True
+    while i < len(p):
+        m = token_pattern.match(p, i)
+        kind = m.lastgroup
+        c = i - start
+        i = m.end()
+        match kind:
+            case 'space':
+                newlines = m[0].count('\n')
+                if newlines:
+                    l += newlines
+                    start = m[0].rindex('\n') + m.start() + 1
+                spaced = True
+                continue
+            case 'string':
+                line = l
+                newlines = m[0].count('\n')
+                if newlines:
+                    l += newlines
+                    start = m[0].rindex('\n') + m.start() + 1
+                value, i, l, start = lex_string(p, i, l, start)
+                if isinstance(value, ParsingError):
+                    tokens.append(Token('error', value, value.line,
+                                        value.column, spaced))
+                    break
+                tokens.append(Token('string', value, line, c, spaced))
+            case 'dot':
+                tokens.append(Token('.', '.', l, c, spaced))
+            case kind:
+                tokens.append(Token(kind, m[0], l, c, spaced))
+        spaced = False
+    tokens.append(Token('eof', None, l, len(p) - start, spaced))
+    return tokens
+
+
+def parse_char(char):
+    message = f'Expected "{char}"'
+    def f(t, i):
+        if t[i].kind == char:
+            return i + 1, char
+        return fail(i, message)
     return f
 
 
 def parse_word(word):
-    parsers = [parse_char(c) for c in word]
-    def f(p, i, l, c):
-        ni, nl, nc = i, l, c
-        for parser in parsers:
-            match parser(p, ni, nl, nc):
-                case _, _, _, ParsingError():
-                    return i, l, c, ParsingError(l, c, f'Expected "{word}"')
-                case ni, nl, nc, _:
-                    pass
-        return ni, nl, nc, word
+    message = f'Expected "{word}"'
+    def f(t, i):
+        token = t[i]
+        if token.kind == 'word' and token.value == word:
+            return i + 1, word
+        return fail(i, message)
     return f
 
 
 def parse_any_word(words):
-    parsers = [parse_word(s) for s in words]
-    def f(p, i, l, c):
-        for parser in parsers:
-            match parser(p, i, l, c):
-                case _, _, _, ParsingError():
-                    pass
-                case parsed:
-                    return parsed
-        return i, l, c, ParsingError(l, c,
-            f'Expected one of [{", ".join([repr(s) for s in words])}]')
+    message = f'Expected one of [{", ".join([repr(s) for s in words])}]'
+    words = set(words)
+    def f(t, i):
+        token = t[i]
+        if token.kind == 'word' and token.value in words:
+            return i + 1, token.value
+        return fail(i, message)
     return f
 
 
-parse_one_whitespace = parse_any_char('\n\r\t ')
-
-
-parse_whitespace = parse_many(parse_one_whitespace)
-
-
-parse_whitespace_separator = chain(parse_one_whitespace, parse_whitespace)
+whitespace_message = f'Expected one of {repr(whitespace)}'
+def parse_whitespace_separator(t, i):
+    if t[i].spaced:
+        return i, whitespace
+    return fail(i, whitespace_message)
 
 
 def parse_separated(parser):
     parser = chain(parse_whitespace_separator, parser)
-    def f(p, i, l, c):
-        match parser(p, i, l, c):
-            case i, l, c, ParsingError() as e:
-                return i, l, c, e
-            case i, l, c, [_, value]:
-                return i, l, c, value
+    def f(t, i):
+        match parser(t, i):
+            case i, Failure() as e:
+                return i, e
+            case i, [_, value]:
+                return i, value
             case a:
                 raise ValueError(a)
     return f
@@ -178,192 +331,172 @@ def parse_words(*words):
     parsers = [parse_word(words[0])] + [parse_separated(parse_word(w)) for w in words[1:]]
     return chain(*parsers)
 
-####   Parsing (and some lexing also)   ####
+####   Parsing   ####
 
-escapes = {'\\': '\\', '"': '"', 'n': '\n'}
-def parse_string_body(p, i, l, c):
-    ans = ''
-    try:
-        while p[i] != '"':
-            if p[i] == '\\':
-                i += 1
-                c += 1
-                if p[i] not in escapes:
-                    return i, l, c, ParsingError(l, c,
-                        f'Incorrect escape sequence. Did you mean "\\\\"?')
-                ans += escapes[p[i]]
-            else:
-                ans += p[i]
-            if p[i] == '\n':
-                l += 1
-                c = 0
-            else:
-                c += 1
-            i += 1
-    except IndexError:
-        return i, l, c, ParsingError(l, c,
-            f'Unexpected EOF while parsing a string')
-    return i + 1, l, c + 1, ans
-
-
-def parse_string(p, i, l, c):
-    parser = chain(parse_word('nimi'),
-                   parse_whitespace_separator,
-                   parse_char('"'),
-                   parse_string_body)
-    match parser(p, i, l, c):
-        case i, l, c, ['nimi', _, '"', value]:
-            return i, l, c, LiteralExpr(value)
-        case i, l, c, ParsingError() as e:
-            return i, l, c, e
-        case a:
-            raise ValueError(str(a))
+@memoize
+def parse_string(t, i):
+    token = t[i]
+    if token.kind == 'string':
+        return i + 1, LiteralExpr(token.value)
+    return fail(i, 'Expected "nimi"')
 
 
 numbers = {'ali': 100, 'ale': 100, 'mute': 20, 'luka': 5, 'tu': 2, 'wan': 1}
-nonzero_number_parser = parse_any_word(list(numbers))
-def parse_int_body(p, i, l, c):
-    i, l, c, word = parse_any_word(list(numbers) + ['ala', 'nasa'])(p, i, l, c)
+nonzero_number_parser = parse_separated(parse_any_word(list(numbers)))
+number_parser = parse_any_word(list(numbers) + ['ala', 'nasa'])
+def parse_int_body(t, i):
+    i, word = number_parser(t, i)
     match word:
-        case ParsingError():
-            return i, l, c, word
+        case Failure():
+            return i, word
         case 'ala':
-            return i, l, c, 0
+            return i, 0
         case 'nasa':
-            return i, l, c, Random
+            return i, Random
     ans = numbers[word]
     while True:
         prev = numbers[word]
-        match parse_separated(nonzero_number_parser)(p, i, l, c):
-            case _, _, _, ParsingError() as e:
-                return i, l, c, ans
-            case ni, nl, nc, word:
+        match nonzero_number_parser(t, i):
+            case _, Failure() as e:
+                return i, ans
+            case ni, word:
                 if numbers[word] > prev:
-                    return i, l, c, ParsingError(l, c,
-                        f'Number words must be in a non-increasing order')
+                    return fail(i,
+                        'Number words must be in a non-increasing order')
                 ans += numbers[word]
-                i, l, c = ni, nl, nc
+                i = ni
             case a:
                 raise ValueError(a)
 
 
-def parse_int(p, i, l, c):
-    parser = chain(parse_word('nanpa'),
+int_parser = chain(parse_word('nanpa'),
                    parse_whitespace_separator,
                    parse_int_body)
-    match parser(p, i, l, c):
-        case i, l, c, ['nanpa', _, RandomExpr() as value]:
-            return i, l, c, value
-        case i, l, c, ['nanpa', _, int() as value]:
-            return i, l, c, LiteralExpr(value)
-        case i, l, c, ParsingError() as e:
-            return i, l, c, e
+
+@memoize
+def parse_int(t, i):
+    match int_parser(t, i):
+        case i, ['nanpa', _, RandomExpr() as value]:
+            return i, value
+        case i, ['nanpa', _, int() as value]:
+            return i, LiteralExpr(value)
+        case i, Failure() as e:
+            return i, e
         case a:
             raise ValueError(str(a))
 
 
-# I got really annoyed by trying to make a parser for tp names.
-id_pattern = re.compile('(?:(?:[AEIOU])|(?:[JKLMNPSTW][aeiou]))(?:n?(?![aeiou]))?(?:[jklmnpstw][aeiou](?:n(?![aeiou]))?)*')
-def parse_identifier(p, i, l, c):
-    m = id_pattern.match(p, i)
-    if not m:
-        return i, l, c, ParsingError(l, c, f'Expected an identifier')
-    m = m[0]
-    return i + len(m), l, c + len(m), m
-
-
-def parse_variable(p, i, l, c):
-    parser = chain(parse_word('ijo'),
-                   option(alter(parse_separated(parse_word('lili')),
-                                parse_separated(parse_word('suli')))),
-                   parse_separated(parse_identifier))
-    match parser(p, i, l, c):
-        case i, l, c, ParsingError() as e:
-            return i, l, c, e
-        case i, l, c, ['ijo', var_type, str() as identifier]:
-            return i, l, c, VariableExpr(var_type, identifier)
+def parse_identifier(t, i):
+    token = t[i]
+    if token.kind != 'identifier':
+        return fail(i, 'Expected an identifier')
+    return i + 1, token.value
+
+
+variable_parser = chain(parse_word('ijo'),
+                        option(alter(parse_separated(parse_word('lili')),
+                                     parse_separated(parse_word('suli')))),
+                        parse_separated(parse_identifier))
+
+@memoize
+def parse_variable(t, i):
+    match variable_parser(t, i):
+        case i, Failure() as e:
+            return i, e
+        case i, ['ijo', var_type, str() as identifier]:
+            return i, VariableExpr(var_type, identifier)
         case a:
             raise ValueError(a)
 
 
-def parse_simple_expression(p, i, l, c):
-    parser = alter(parse_int, parse_string, parse_word('ala'),
-                   parse_word('lon'), parse_word('kulupu'),
-                   chain(parse_word('pali'), parse_separated(parse_word('ni'))),
-                   parse_variable)
-    i, l, c, value = parser(p, i, l, c)
+simple_expression_parser = alter(
+    parse_int, parse_string, parse_word('ala'),
+    parse_word('lon'), parse_word('kulupu'),
+    chain(parse_word('pali'), parse_separated(parse_word('ni'))),
+    parse_variable)
+
+@memoize
+def parse_simple_expression(t, i):
+    i, value = simple_expression_parser(t, i)
     match value:
-        case ParsingError() as e:
-            return i, l, c, e
+        case Failure() as e:
+            return i, e
         case 'ala':
-            return i, l, c, LiteralExpr(None)
+            return i, LiteralExpr(None)
         case 'lon':
-            return i, l, c, LiteralExpr(True)
+            return i, LiteralExpr(True)
         case 'kulupu':
-            return i, l, c, LiteralExpr({})
+            return i, LiteralExpr({})
         case ['pali', 'ni']:
-            return i, l, c, Recursion
+            return i, Recursion
         case Expression():
-            return i, l, c, value
+            return i, value
         case a:
             raise ValueError(a)
 
 
-def parse_pi_expression(p, i, l, c):
-    i, l, c, value = parse_simple_expression(p, i, l, c)
-    if isinstance(value, ParsingError):
-        return i, l, c, value
-    pi_parser = parse_separated(parse_word('pi'))
-    next_expr_parser = parse_separated(parse_simple_expression)
+pi_parser = parse_separated(parse_word('pi'))
+separated_simple_expression_parser = parse_separated(parse_simple_expression)
+
+@memoize
+def parse_pi_expression(t, i):
+    i, value = parse_simple_expression(t, i)
+    if value is FAIL:
+        return i, value
     while True:
-        match pi_parser(p, i, l, c):
-            case _, _, _, ParsingError():
-                return i, l, c, value
-            case i, l, c, 'pi':
+        match pi_parser(t, i):
+            case _, Failure():
+                return i, value
+            case i, 'pi':
                 pass
             case a:
                 raise ValueError(a)
-        match next_expr_parser(p, i, l, c):
-            case i, l, c, ParsingError() as e:
-                return i, l, c, e
-            case i, l, c, next_expr:
+        match separated_simple_expression_parser(t, i):
+            case i, Failure() as e:
+                return i, e
+            case i, next_expr:
                 value = BinExpr('pi', value, next_expr)
             case a:
                 raise ValueError(a)
 
 
-def parse_ala_expression(p, i, l, c):
-    i, l, c, value = parse_pi_expression(p, i, l, c)
-    if isinstance(value, ParsingError):
-        return i, l, c, value
+ala_parser = parse_separated(parse_word('ala'))
+
+@memoize
+def parse_ala_expression(t, i):
+    i, value = parse_pi_expression(t, i)
+    if value is FAIL:
+        return i, value
     while True:
-        match parse_separated(parse_word('ala'))(p, i, l, c):
-            case _, _, _, ParsingError():
-                return i, l, c, value
-            case i, l, c, 'ala':
+        match ala_parser(t, i):
+            case _, Failure():
+                return i, value
+            case i, 'ala':
                 value = NegateExpr(value)
             case a:
                 raise ValueError(a)
 
 
-def parse_expression(p, i, l, c):
-    i, l, c, value = parse_ala_expression(p, i, l, c)
-    if isinstance(value, ParsingError):
-        return i, l, c, value
-    en_parser = parse_separated(parse_word('en'))
-    next_expr_parser = parse_separated(parse_ala_expression)
+en_parser = parse_separated(parse_word('en'))
+separated_ala_expression_parser = parse_separated(parse_ala_expression)
+
+@memoize
+def parse_expression(t, i):
+    i, value = parse_ala_expression(t, i)
+    if value is FAIL:
+        return i, value
     while True:
-        match en_parser(p, i, l, c):
-            case _, _, _, ParsingError():
-                return i, l, c, value
-            case i, l, c, 'en':
+        match en_parser(t, i):
+            case _, Failure():
+                return i, value
+            case i, 'en':
                 pass
             case a:
                 raise ValueError(a)
-        match next_expr_parser(p, i, l, c):
-            case i, l, c, ParsingError() as e:
-                return i, l, c, e
-            case i, l, c, next_expr:
+        match separated_ala_expression_parser(t, i):
+            case i, Failure() as e:
+                return i, e
+            case i, next_expr:
                 value = BinExpr('en', value, next_expr)
             case a:
                 raise ValueError(a)
@@ -371,256 +504,306 @@ def parse_expression(p, i, l, c):
 
 parse_verb = parse_any_word(['pali', 'pana', 'lukin', 'sitelen', 'kipisi',
                               'open', 'pini'])
+verb_or_expression_parser = alter(parse_verb, parse_expression)
+e_parser = parse_separated(parse_word('e'))
+separated_expression_parser = parse_separated(parse_expression)
+kepeken_parser = parse_separated(parse_word('kepeken'))
 
-def parse_sentence_body(p, i, l, c):
+@memoize
+def parse_sentence_body(t, i):
     verb = None
     first = LiteralExpr(None)
     args = []
-    match alter(parse_verb, parse_expression)(p, i, l, c):
-        case i, l, c, ParsingError() as e:
-            return i, l, c, e
-        case i, l, c, Expression() as expr:
-            return i, l, c, expr
-        case i, l, c, str() as verb:
+    match verb_or_expression_parser(t, i):
+        case i, Failure() as e:
+            return i, e
+        case i, Expression() as expr:
+            return i, expr
+        case i, str() as verb:
             pass
         case a:
             raise ValueError(a)
-    match parse_separated(parse_word('e'))(p, i, l, c):
-        case _, _, _, ParsingError() as e:
-            return i, l, c, VerbExpr(verb, first, args)
-        case i, l, c, 'e':
+    match e_parser(t, i):
+        case _, Failure() as e:
+            return i, VerbExpr(verb, first, args)
+        case i, 'e':
             pass
         case a:
             ValueError(a)
-    match parse_separated(parse_expression)(p, i, l, c):
-        case i, l, c, ParsingError() as e:
-            return i, l, c, e
-        case i, l, c, Expression() as first:
+    match separated_expression_parser(t, i):
+        case i, Failure() as e:
+            return i, e
+        case i, Expression() as first:
             pass
         case a:
             raise ValueError(a)
-    match parse_arguments(p, i, l, c):
-        case i, l, c, ParsingError() as e:
-            return i, l, c, e
-        case i, l, c, args:
-            return i, l, c, VerbExpr(verb, first, args)
+    match parse_arguments(t, i):
+        case i, Failure() as e:
+            return i, e
+        case i, args:
+            return i, VerbExpr(verb, first, args)
         case a:
             raise ValueError(a)
 
 
-def parse_arguments(p, i, l, c):
+@memoize
+def parse_arguments(t, i):
     args = []
     while True:
-        match parse_separated(parse_word('kepeken'))(p, i, l, c):
-            case _, _, _, ParsingError() as e:
-                return i, l, c, args
-            case i, l, c, 'kepeken':
+        match kepeken_parser(t, i):
+            case _, Failure() as e:
+                return i, args
+            case i, 'kepeken':
                 pass
             case a:
                 raise ValueError(a)
-        match parse_separated(parse_expression)(p, i, l, c):
-            case i, l, c, ParsingError() as e:
-                return i, l, c, e
-            case i, l, c, Expression() as arg:
+        match separated_expression_parser(t, i):
+            case i, Failure() as e:
+                return i, e
+            case i, Expression() as arg:
                 args.append(arg)
             case a:
                 raise ValueError(a)
-    
 
-def parse_assignment(p, i, l, c):
-    i, l, c, var = parse_variable(p, i, l, c)
+
+@memoize
+def parse_assignment(t, i):
+    i, var = parse_variable(t, i)
     match var:
-        case ParsingError():
-            return i, l, c, var
+        case Failure():
+            return i, var
         case VariableExpr():
             pass
         case a:
             raise ValueError(a)
-    match parse_separated(parse_word('pi'))(p, i, l, c):
-        case _, _, _, ParsingError():
-            return i, l, c, var
-        case i, l, c, 'pi':
+    match pi_parser(t, i):
+        case _, Failure():
+            return i, var
+        case i, 'pi':
             pass
         case a:
             raise ValueError(a)
-    match parse_separated(parse_simple_expression)(p, i, l, c):
-        case i, l, c, ParsingError() as e:
-            return i, l, c, e
-        case i, l, c, Expression() as index:
+    match separated_simple_expression_parser(t, i):
+        case i, Failure() as e:
+            return i, e
+        case i, Expression() as index:
             pass
         case a:
             raise ValueError(a)
     while True:
-        match parse_separated(parse_word('pi'))(p, i, l, c):
-            case _, _, _, ParsingError():
-                return i, l, c, TableAssignment(var, index)
-            case i, l, c, 'pi':
+        match pi_parser(t, i):
+            case _, Failure():
+                return i, TableAssignment(var, index)
+            case i, 'pi':
                 pass
             case a:
                 raise ValueError(a)
-        match parse_separated(parse_simple_expression)(p, i, l, c):
-            case i, l, c, ParsingError() as e:
-                return i, l, c, e
-            case i, l, c, Expression() as e:
+        match separated_simple_expression_parser(t, i):
+            case i, Failure() as e:
+                return i, e
+            case i, Expression() as e:
                 var = BinExpr('pi', var, index)
                 index = e
             case a:
                 raise ValueError(a)
-            
 
-def parse_condition(p, i, l, c):
-    match parse_expression(p, i, l, c):
-        case i, l, c, ParsingError() as e:
-            return i, l, c, e
-        case i, l, c, Expression() as expr:
+
+comparison_parser = chain(parse_separated(parse_word('li')),
+                          parse_separated(alter(parse_word('lili'),
+                                                parse_word('suli'),
+                                                parse_expression)))
+
+@memoize
+def parse_condition(t, i):
+    match parse_expression(t, i):
+        case i, Failure() as e:
+            return i, e
+        case i, Expression() as expr:
             pass
         case a:
             raise ValueError(a)
-    match chain(parse_separated(parse_word('li')),
-                parse_separated(alter(parse_word('lili'),
-                                      parse_word('suli'),
-                                      parse_expression)))(p, i, l, c):
-        case _, _, _, ParsingError() as e:
-            return i, l, c, expr
-        case i, l, c, ['li', 'lili']:
-            return i, l, c, ComparisonExpr('lili', expr)
-        case i, l, c, ['li', 'suli']:
-            return i, l, c, ComparisonExpr('suli', expr)
-        case i, l, c, ['li', Expression() as right]:
-            return i, l, c, BinExpr('li', expr, right)
+    match comparison_parser(t, i):
+        case _, Failure() as e:
+            return i, expr
+        case i, ['li', 'lili']:
+            return i, ComparisonExpr('lili', expr)
+        case i, ['li', 'suli']:
+            return i, ComparisonExpr('suli', expr)
+        case i, ['li', Expression() as right]:
+            return i, BinExpr('li', expr, right)
         case a:
             raise ValueError(a)
 
 
-def parse_paragraph(p, i, l, c):
-    match parse_words('pali', 'ni')(p, i, l, c):
-        case _, _, _, ParsingError():
+pali_ni_parser = parse_words('pali', 'ni')
+first_argument_parser = parse_separated(chain(
+    parse_words('li', 'kepeken', 'e', 'ijo'),
+    parse_separated(parse_identifier)))
+next_argument_parser = alter(parse_char('.'),
+                             chain(parse_separated(parse_words('e', 'ijo')),
+                                   parse_separated(parse_identifier)))
+dot_parser = parse_char('.')
+
+@memoize
+def parse_paragraph(t, i):
+    start = t[i]
+    match pali_ni_parser(t, i):
+        case _, Failure():
             arguments = []
-        case i, l, c, ['pali', 'ni']:
-            match parse_separated(chain(
-                                parse_words('li', 'kepeken', 'e', 'ijo'),
-                                parse_separated(parse_identifier)))(p, i, l, c):
-                case i, l, c, ParsingError() as e:
-                    return i, l, c, e
-                case i, l, c, [['li', 'kepeken', 'e', 'ijo'], str() as identifier]:
+        case i, ['pali', 'ni']:
+            match first_argument_parser(t, i):
+                case i, Failure() as e:
+                    return i, e
+                case i, [['li', 'kepeken', 'e', 'ijo'], str() as identifier]:
                     arguments = [VariableExpr('lili', identifier)]
                 case a:
                     raise ValueError(a)
             while True:
-                match alter(chain(parse_whitespace, parse_char('.')),
-                            chain(parse_separated(parse_words('e', 'ijo')),
-                                  parse_separated(parse_identifier)))(p, i, l, c):
-                    case i, l, c, ParsingError() as e:
-                        return i, l, c, e
-                    case i, l, c, [_, '.']:
+                match next_argument_parser(t, i):
+                    case i, Failure() as e:
+                        return i, e
+                    case i, '.':
                         break
-                    case i, l, c, [['e', 'ijo'], str() as identifier]:
+                    case i, [['e', 'ijo'], str() as identifier]:
                         arguments.append(VariableExpr(None, identifier))
                     case a:
                         raise ValueError(a)
         case a:
             raise ValueError(a)
     if arguments:
-        match parse_whitespace_separator(p, i, l, c):
-            case i, l, c, ParsingError() as e:
-                return i, l, c, e
-            case i, l, c, _:
+        match parse_whitespace_separator(t, i):
+            case i, Failure() as e:
+                return i, e
+            case i, _:
                 pass
             case a:
                 raise ValueError(a)
     sentences = []
-    while i < len(p):
-        match alter(parse_words('pali', 'sin', 'li', 'pini'),
-                    parse_sentence)(p, i, l, c):
-            case i, l, c, ParsingError() as e:
-                return i, l, c, e
-            case i, l, c, ['pali', 'sin', 'li', 'pini']:
+    while t[i].kind != 'eof':
+        match sentence_or_end_parser(t, i):
+            case i, Failure() as e:
+                return i, e
+            case i, ['pali', 'sin', 'li', 'pini']:
                 break
-            case i, l, c, Sentence() as s:
+            case i, Sentence() as s:
                 sentences.append(s)
             case a:
                 raise ValueError(a)
-        if i == len(p):
+        if t[i].kind == 'eof':
             break
-        match parse_whitespace_separator(p, i, l, c):
-            case i, l, c, ParsingError() as e:
-                return i, l, c, e
-            case i, l, c, _:
+        match parse_whitespace_separator(t, i):
+            case i, Failure() as e:
+                return i, e
+            case i, _:
                 pass
             case a:
                 raise ValueError(a)
-    return i, l, c, Paragraph(arguments, sentences)
-
-
-def parse_sentence(p, i, l, c):
+    return i, Paragraph(arguments, sentences, start.line, start.column)
+
+
+condition_parser = chain(parse_condition, parse_separated(parse_word('la')))
+assignment_parser = alter(parse_word('o'),
+                          chain(parse_assignment,
+                                parse_separated(parse_word('li'))))
+sentence_body_parser = parse_separated(alter(
+    parse_words('pali', 'sin'),
+    parse_words('pali', 'e', 'pali', 'sin'),
+    parse_sentence_body))
+nested_paragraph_parser = chain(dot_parser, parse_separated(parse_paragraph))
+
+@memoize
+def parse_sentence(t, i):
+    start = t[i]
     conditions = []
     while True:
-        match chain(parse_condition, parse_separated(parse_word('la')))(p, i, l, c):
-            case _, _, _, ParsingError():
+        match condition_parser(t, i):
+            case _, Failure():
                 break
-            case i, l, c, [Expression() as cond, 'la']:
+            case i, [Expression() as cond, 'la']:
                 conditions.append(cond)
             case a:
                 raise ValueError(a)
-        i, l, c, _ = parse_whitespace_separator(p, i, l, c)
-    match alter(parse_word('o'),
-                chain(parse_assignment, parse_separated(parse_word('li'))))(p, i, l, c):
-        case i, l, c, ParsingError() as e:
-            return i, l, c, e
-        case i, l, c, 'o':
+        i, _ = parse_whitespace_separator(t, i)
+    match assignment_parser(t, i):
+        case i, Failure() as e:
+            return i, e
+        case i, 'o':
             assignment = None
-        case i, l, c, [VariableExpr() | TableAssignment() as assignment, 'li']:
+        case i, [VariableExpr() | TableAssignment() as assignment, 'li']:
             pass
         case a:
             raise ValueError(a)
-    match parse_separated(alter(parse_words('pali', 'sin'),
-                                parse_words('pali', 'e', 'pali', 'sin'),
-                                parse_sentence_body))(p, i, l, c):
-        case i, l, c, ParsingError() as e:
-            return i, l, c, e
-        case i, l, c, ['pali', 'sin']:
-            match chain(parse_whitespace, parse_char('.'),
-                        parse_separated(parse_paragraph))(p, i, l, c):
-                case i, l, c, ParsingError() as e:
-                    return i, l, c, e
-                case i, l, c, [_, '.', Paragraph() as par]:
+    match sentence_body_parser(t, i):
+        case i, Failure() as e:
+            return i, e
+        case i, ['pali', 'sin']:
+            match nested_paragraph_parser(t, i):
+                case i, Failure() as e:
+                    return i, e
+                case i, ['.', Paragraph() as par]:
                     expr = LiteralExpr(par)
                 case a:
                     raise ValueError(a)
-        case i, l ,c, ['pali', 'e', 'pali', 'sin']:
-            match parse_arguments(p, i, l, c):
-                case i, l, c, ParsingError() as e:
-                    return i, l, c, e
-                case i, l, c, args:
+        case i, ['pali', 'e', 'pali', 'sin']:
+            match parse_arguments(t, i):
+                case i, Failure() as e:
+                    return i, e
+                case i, args:
                     pass
                 case a:
                     raise ValueError(a)
-            match chain(parse_whitespace, parse_char('.'),
-                        parse_separated(parse_paragraph))(p, i, l, c):
-                case i, l, c, ParsingError() as e:
-                    return i, l, c, e
-                case i, l, c, [_, '.', Paragraph() as par]:
+            match nested_paragraph_parser(t, i):
+                case i, Failure() as e:
+                    return i, e
+                case i, ['.', Paragraph() as par]:
                     expr = VerbExpr('pali', LiteralExpr(par), args)
                 case a:
                     raise ValueError(a)
-        case i, l, c, Expression() as expr:
+        case i, Expression() as expr:
             pass
         case a:
             raise ValueError(a)
-    match chain(parse_whitespace, parse_char('.'))(p, i, l, c):
-        case i, l, c, ParsingError() as e:
-            return i, l, c, e
-        case i, l, c, [_, '.']:
-            return i, l, c, Sentence(conditions, assignment, expr)
+    match dot_parser(t, i):
+        case i, Failure() as e:
+            return i, e
+        case i, '.':
+            return i, Sentence(conditions, assignment, expr,
+                               start.line, start.column)
         case a:
             raise ValueError(a)
 
 
+sentence_or_end_parser = alter(parse_words('pali', 'sin', 'li', 'pini'),
+                               parse_sentence)
+
+
+def failure_error(t):
+    '''
+    Builds the error of a failed parse. Malformed strings
+    are reported by the lexer, which stops right after them.
+    '''
+    token = t[furthest.i]
+    if token.kind == 'error':
+        return token.value
+    return error(token, furthest.message)
+
+
 def parser(p):
-    match chain(parse_whitespace, parse_paragraph)(p, 0, 0, 0):
-        case _, _, _, ParsingError() as e:
-            return e
-        case _, _, _, [_, Paragraph() as p]:
+    memo.clear()
+    furthest.clear()
+    collecting = gc.isenabled()
+    gc.disable()
+    try:
+        t = lex(p)
+        parsed = parse_paragraph(t, 0)
+    finally:
+        memo.clear()
+        if collecting:
+            gc.enable()
+    match parsed:
+        case _, Failure():
+            return failure_error(t)
+        case _, Paragraph() as p:
             return p
         case a:
             raise ValueError(a)
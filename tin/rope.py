@@ -0,0 +1,109 @@
+'''
+Strings built with en, shared by all the engines.
+
+Adding two python strs copies both, so building an n character string
+by adding to it again and again costs O(n²). Once the result of en is
+at least MIN_LENGTH characters long it's a Rope instead: the first
+length characters of a Buffer, which is only ever appended to.
+Adding to a Rope covering its whole buffer appends to the buffer in
+place and returns a longer Rope of the same buffer, so every append
+costs the length of the appended string. Adding to a Rope whose buffer
+was appended to since (the same string extended in two different ways)
+copies it into a new buffer first.
+
+A Rope is flattened into a str, which it keeps, when its characters are
+needed: when it's indexed with pi, cut with kipisi, compared with li,
+written with sitelen, used as a table key or as the name of a lipu.
+It compares and hashes equal to its str, so tin programs can't tell
+the two apart.
+'''
+
+
+MIN_LENGTH = 256
+
+# Appended strings are joined into a chunk every CHUNK appends,
+# so building from short strings doesn't keep them all alive
+CHUNK = 1024
+
+
+class Buffer:
+
+    __slots__ = ('chunks', 'pending', 'length')
+
+    def __init__(self, text: str):
+        self.chunks = [text]
+        self.pending = []
+        self.length = len(text)
+
+    def append(self, text: str):
+        pending = self.pending
+        pending.append(text)
+        self.length += len(text)
+        if len(pending) == CHUNK:
+            self.chunks.append(''.join(pending))
+            pending.clear()
+
+    def text(self) -> str:
+        if self.pending:
+            self.chunks.append(''.join(self.pending))
+            self.pending.clear()
+        if len(self.chunks) > 1:
+            self.chunks = [''.join(self.chunks)]
+        return self.chunks[0]
+
+
+class Rope:
+
+    __slots__ = ('buffer', 'length', 'flat')
+
+    def __init__(self, buffer: Buffer):
+        self.buffer = buffer
+        self.length = buffer.length
+        self.flat = None
+
+    def __str__(self) -> str:
+        if self.flat is None:
+            text = self.buffer.text()
+            self.flat = text if len(text) == self.length else text[:self.length]
+        return self.flat
+
+    def __repr__(self) -> str:
+        return repr(str(self))
+
+    def __len__(self) -> int:
+        return self.length
+
+    def __getitem__(self, key):
+        return str(self)[key]
+
+    def __eq__(self, other):
+        if type(other) is str or type(other) is Rope:
+            return str(self) == str(other)
+        return NotImplemented
+
+    def __hash__(self):
+        return hash(str(self))
+
+
+# Types of tin strings
+STRINGS = (str, Rope)
+
+
+def concat(a, b):
+    '''
+    a en b for strings a and b, either of which may be a Rope.
+    '''
+    if type(b) is Rope:
+        b = str(b)
+    if type(a) is Rope:
+        buffer = a.buffer
+        if buffer.length != a.length:
+            buffer = Buffer(str(a))
+        buffer.append(b)
+        return Rope(buffer)
+    if len(a) + len(b) < MIN_LENGTH:
+        return a + b
+    buffer = Buffer(a)
+    buffer.append(b)
+    return Rope(buffer)
+
@@ -0,0 +1,86 @@
+from threading import Thread, Event
+from bisect import bisect_right
+
+
+'''
+A sampling profiler for the virtual machine.
+
+A thread wakes up every interval and records the paragraph and
+instruction being executed together with the call stack kept in
+the machine's ret. The machine itself runs unchanged, so sampling
+only costs the time the thread holds the GIL. Samples are taken no
+more often than python switches threads, see sys.setswitchinterval.
+
+Samples are written as folded stacks, one line per distinct stack
+with frames separated by semicolons followed by the number of
+samples, which is the input format of flamegraph.pl and speedscope.
+With a debug table in the bytecode (compiler option debug, -g in
+tin_cli.py) frames are named after the source line and column of
+the sentence being executed, otherwise after instruction indices.
+'''
+
+
+INTERVAL = 0.001
+
+
+class Sampler:
+
+    def __init__(self, interval: float = INTERVAL):
+        self.interval = interval
+        # Numbers of samples by stacks of (paragraph, instruction index)
+        self.samples = {}
+        # Numbers of samples by stacks of frame names, set by stop
+        self.stacks = {}
+        self.vm = None
+        self.thread = None
+        self.stopped = Event()
+
+    def sample(self):
+        vm = self.vm
+        # ip already points past the running instruction, except right
+        # after a call, and return addresses point past the calling pali
+        stack = tuple((par, ip - 1) for par, ip, *_ in list(vm.ret))
+        stack += ((vm.par, max(vm.ip - 1, 0)),)
+        self.samples[stack] = self.samples.get(stack, 0) + 1
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    def start(self, vm):
+        self.vm = vm
+        self.stopped.clear()
+        self.thread = Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        '''
+        Stops sampling and names the frames of the samples,
+        which needs the bytecode, so before it's released.
+        '''
+        self.stopped.set()
+        self.thread.join()
+        pars = self.vm.pars
+        positions = {}
+
+        def frame(par, ip):
+            if par not in positions:
+                positions[par] = pars.positions(par)
+            found = positions[par]
+            n = bisect_right(found, ip, key=lambda position: position[0])
+            if n == 0:
+                return f'pali {par} #{ip}'
+            _, line, column = found[n - 1]
+            return f'pali {par} {line + 1}:{column + 1}'
+
+        self.stacks = {}
+        for stack, count in self.samples.items():
+            names = ';'.join(frame(par, ip) for par, ip in stack)
+            self.stacks[names] = self.stacks.get(names, 0) + count
+
+    def folded(self) -> str:
+        '''
+        Returns the samples as folded stacks.
+        '''
+        return ''.join(f'{stack} {count}\n' for stack, count
+                       in sorted(self.stacks.items(), key=lambda x: -x[1]))
@@ -0,0 +1,409 @@
+from .AST import *
+from .environment import Environment
+from .output import output
+from .input import readline, reading
+from .rope import Rope, STRINGS, concat
+from random import randrange
+from io import TextIOWrapper
+from hashlib import sha256
+
+
+'''
+Translates the AST into python source code.
+
+Every paragraph becomes a python function of type:
+(env, args) -> value
+wrapped in a Procedure, which is the tin value of that paragraph.
+Expressions become python expressions calling the helpers below.
+
+A paragraph calling itself with pali ni in its last sentence runs
+in a while loop instead of recursing. Variables which are only ever
+used as ijo lili anywhere in the program can't be reached through
+dynamic scoping, so they become python locals.
+
+Other calls use python recursion, so very deep non-tail recursion
+is limited by the python stack.
+'''
+
+
+class Procedure:
+
+    def __init__(self, function):
+        self.function = function
+
+
+####   Runtime helpers   ####
+
+def represent(val):
+    match val:
+        case True:
+            return '[lon]'
+        case False:
+            return '[lon ala]'
+        case int():
+            return '[nanpa]'
+        case str():
+            return val
+        case Rope():
+            return str(val)
+        case Procedure():
+            return '[pali]'
+        case dict():
+            return '[kulupu]'
+        case TextIOWrapper():
+            return '[lipu]'
+        case None:
+            return '[ala]'
+        case a:
+            raise ValueError(a)
+
+
+def add(a, b):
+    if type(a) is int and type(b) is int:
+        return a + b
+    if type(a) in STRINGS and type(b) in STRINGS:
+        return concat(a, b)
+    return None
+
+
+def pi(a, b):
+    if type(a) is dict:
+        if b in a:
+            return a[b]
+        return None
+    if type(a) in STRINGS and type(b) is int and 0 <= b < len(a):
+        return a[b]
+    return None
+
+
+def negate(a):
+    if type(a) is bool:
+        return not a
+    if type(a) is int:
+        return -a
+    return None
+
+
+def smaller(a):
+    return type(a) is int and a < 0
+
+
+def bigger(a):
+    return type(a) is int and a > 0
+
+
+def call(p, env, args):
+    if type(p) is Procedure:
+        return p.function(env, args)
+    return None
+
+
+def lukin(source):
+    output.flush()
+    if isinstance(source, TextIOWrapper) and not source.closed \
+       and source.readable():
+        return source.readline()
+    return readline()
+
+
+def sitelen(value, file):
+    if isinstance(file, TextIOWrapper) and not file.closed \
+       and file.writable():
+        output.write(represent(value), file)
+    else:
+        output.write(represent(value))
+
+
+def clamp(n, length):
+    return min(max(n, 0), length)
+
+
+def kipisi(s, a=None, b=None):
+    if type(s) not in STRINGS:
+        return None
+    a = clamp(a, len(s)) if type(a) is int else 0
+    b = clamp(b, len(s)) if type(b) is int else len(s)
+    return s[a:b]
+
+
+def open_file(name, mode=None):
+    if type(name) not in STRINGS:
+        return None
+    try:
+        return open(str(name), 'w' if mode == 'sitelen' else 'r')
+    except Exception:
+        return None
+
+
+def pini(file):
+    if isinstance(file, TextIOWrapper) and not file.closed:
+        output.close(file)
+
+
+RUNTIME = ['Environment', 'Procedure', 'randrange', 'represent', 'add',
+           'pi', 'negate', 'smaller', 'bigger', 'call', 'lukin', 'sitelen',
+           'kipisi', 'open_file', 'pini', 'output']
+
+
+####   Analysis   ####
+
+def collect(ast, paragraphs, uses):
+    '''
+    Numbers the paragraphs and records every way each
+    variable identifier is used in the program.
+    '''
+    match ast:
+        case LiteralExpr(value=Paragraph() as par):
+            collect(par, paragraphs, uses)
+        case VariableExpr(var_type=var_type, identifier=identifier):
+            uses.setdefault(identifier, set()).add(var_type)
+        case NegateExpr(expr=expr) | ComparisonExpr(expr=expr):
+            collect(expr, paragraphs, uses)
+        case BinExpr(left=left, right=right):
+            collect(left, paragraphs, uses)
+            collect(right, paragraphs, uses)
+        case VerbExpr(first=first, args=args):
+            collect(first, paragraphs, uses)
+            for arg in args:
+                collect(arg, paragraphs, uses)
+        case TableAssignment(table=table, index=index):
+            collect(table, paragraphs, uses)
+            collect(index, paragraphs, uses)
+        case Sentence(conditions=conditions, assignment=assignment, expr=expr):
+            for cond in conditions:
+                collect(cond, paragraphs, uses)
+            collect(assignment, paragraphs, uses)
+            collect(expr, paragraphs, uses)
+        case Paragraph(arguments=arguments, sentences=sentences):
+            if ast not in paragraphs:
+                paragraphs[ast] = len(paragraphs)
+                for arg in arguments:
+                    uses.setdefault(arg.identifier, set()).add('lili')
+                for sentence in sentences:
+                    collect(sentence, paragraphs, uses)
+        case [*exprs]:
+            for expr in exprs:
+                collect(expr, paragraphs, uses)
+
+
+def is_self_tail_call(sentence):
+    match sentence:
+        case Sentence(assignment=None,
+                      expr=VerbExpr(verb='pali', first=RecursiveExpr())):
+            return True
+    return False
+
+
+####   Code generation   ####
+
+class Transpiler:
+
+    def __init__(self, ast):
+        self.paragraphs = {}
+        uses = {}
+        collect(ast, self.paragraphs, uses)
+        self.locals = {k for k, v in uses.items() if v == {'lili'}}
+        # Locals used by the paragraph being generated
+        self.used = set()
+        self.ast = ast
+
+    def name(self, par):
+        return f'P{self.paragraphs[par]}'
+
+    def function(self, par):
+        return f'paragraph_{self.paragraphs[par]}'
+
+    def variable(self, identifier):
+        self.used.add(identifier)
+        return f'v_{identifier}'
+
+    def expression(self, expr, pali_ni):
+        def sub(e):
+            return self.expression(e, pali_ni)
+        match expr:
+            case LiteralExpr(value=Paragraph() as par):
+                return self.name(par)
+            case LiteralExpr(value=dict()):
+                return '{}'
+            case LiteralExpr(value=value):
+                return repr(value)
+            case VariableExpr(var_type='lili', identifier=k) if k in self.locals:
+                return self.variable(k)
+            case VariableExpr(var_type='lili', identifier=k):
+                return f'env.get_local({k!r})'
+            case VariableExpr(var_type='suli', identifier=k):
+                return f'env.get_global({k!r})'
+            case VariableExpr(identifier=k):
+                return f'env.get_first({k!r})'
+            case RandomExpr():
+                return 'randrange(256)'
+            case RecursiveExpr():
+                return self.name(pali_ni)
+            case NegateExpr(expr=e):
+                return f'negate({sub(e)})'
+            case BinExpr(op='li', left=left, right=right):
+                return f'({sub(left)} == {sub(right)})'
+            case BinExpr(op='en', left=left, right=right):
+                return f'add({sub(left)}, {sub(right)})'
+            case BinExpr(op='pi', left=left, right=right):
+                return f'pi({sub(left)}, {sub(right)})'
+            case ComparisonExpr(op='lili', expr=e):
+                return f'smaller({sub(e)})'
+            case ComparisonExpr(op='suli', expr=e):
+                return f'bigger({sub(e)})'
+            case VerbExpr(verb='sitelen', first=first, args=[]):
+                return f'output.write(represent({sub(first)}))'
+            case VerbExpr(verb='sitelen', first=first, args=[dest, *_]):
+                return f'sitelen({sub(first)}, {sub(dest)})'
+            case VerbExpr(verb='lukin', first=first):
+                return f'lukin({sub(first)})'
+            case VerbExpr(verb='kipisi', first=first, args=args):
+                return f'kipisi({", ".join(sub(e) for e in [first] + args[:2])})'
+            case VerbExpr(verb='open', first=first, args=args):
+                return f'open_file({", ".join(sub(e) for e in [first] + args[:1])})'
+            case VerbExpr(verb='pini', first=first):
+                return f'pini({sub(first)})'
+            case VerbExpr(verb='pali', first=first, args=args):
+                args = ''.join(f'{sub(e)}, ' for e in args)
+                return f'call({sub(first)}, env, ({args}))'
+            case None:
+                return 'None'
+        raise ValueError(expr)
+
+    def store(self, assignment, value, pali_ni):
+        match assignment:
+            case VariableExpr(var_type='lili', identifier=k) if k in self.locals:
+                return [f'{self.variable(k)} = {value}']
+            case VariableExpr(var_type='lili', identifier=k):
+                return [f'env.set_local({k!r}, {value})']
+            case VariableExpr(var_type='suli', identifier=k):
+                return [f'env.set_global({k!r}, {value})']
+            case VariableExpr(identifier=k):
+                return [f'env.set_first({k!r}, {value})']
+            case TableAssignment(table=table, index=index):
+                return [f't = {self.expression(table, pali_ni)}',
+                        f'if type(t) is dict:',
+                        f'    i = {self.expression(index, pali_ni)}',
+                        f'    t[i] = {value}',
+                        f'else:',
+                        f'    {value}']
+            case None:
+                return [value]
+        raise ValueError(assignment)
+
+    def sentence(self, sentence, pali_ni, looping, last):
+        match sentence.expr:
+            case VerbExpr(verb='pana', first=first):
+                value = self.expression(first, pali_ni)
+                if looping:
+                    value = f'None if void else {value}'
+                match sentence.assignment:
+                    case TableAssignment(table=table, index=index):
+                        lines = [f't = {self.expression(table, pali_ni)}',
+                                 f'if type(t) is dict:',
+                                 f'    {self.expression(index, pali_ni)}']
+                    case _:
+                        lines = []
+                lines.append(f'return {value}')
+            case VerbExpr(args=args) if looping and last and \
+                                         is_self_tail_call(sentence):
+                args = ''.join(f'{self.expression(e, pali_ni)}, ' for e in args)
+                lines = [f'args = ({args})',
+                         'env = env.tail()',
+                         'void = True',
+                         'continue']
+            case expr:
+                lines = self.store(sentence.assignment,
+                                   self.expression(expr, pali_ni), pali_ni)
+        if not sentence.conditions:
+            return lines
+        conds = ' and '.join(f'(c := {self.expression(cond, pali_ni)}) '
+                             f'is not None and c is not False'
+                             for cond in sentence.conditions)
+        return [f'if {conds}:'] + ['    ' + line for line in lines]
+
+    def paragraph(self, par):
+        looping = bool(par.sentences) and is_self_tail_call(par.sentences[-1])
+        self.used = set()
+        body = []
+        for n, arg in enumerate(par.arguments):
+            value = f'args[{n}] if len(args) > {n} else None'
+            body += self.store(VariableExpr('lili', arg.identifier), value, par)
+        for n, sentence in enumerate(par.sentences, 1):
+            body += self.sentence(sentence, par, looping,
+                                  n == len(par.sentences))
+        body.append('return None')
+        # Locals read before being assigned are ala
+        arguments = {arg.identifier for arg in par.arguments}
+        body = [f'{self.variable(k)} = None'
+                for k in sorted(self.used - arguments)] + body
+        lines = [f'def {self.function(par)}(outer, args):',
+                 '    env = Environment(outer)']
+        if looping:
+            lines += ['    void = False', '    while True:']
+            lines += ['        ' + line for line in body]
+        else:
+            lines += ['    ' + line for line in body]
+        lines.append(f'{self.name(par)} = Procedure({self.function(par)})')
+        return '\n'.join(lines)
+
+    def program(self):
+        pars = sorted(self.paragraphs, key=self.paragraphs.get)
+        return (f'from tin.transpiler import {", ".join(RUNTIME)}\n\n\n' +
+                '\n\n\n'.join(self.paragraph(par) for par in pars) +
+                '\n\n\n'
+                f'def main(args):\n'
+                f'    try:\n'
+                f'        return {self.name(self.ast)}.function(Environment(), (args,))\n'
+                f'    finally:\n'
+                f'        output.flush()\n')
+
+
+def transpiler(ast: Paragraph) -> str:
+    return Transpiler(ast).program()
+
+
+####   Running and caching   ####
+
+# Part of the hash of cached code, changed whenever the generated
+# code changes, so that code cached by older versions is regenerated
+GENERATION = 1
+
+
+def source_hash(source: str, variant: str = '') -> str:
+    if variant:
+        source = f'{variant}\n{source}'
+    source = f'{GENERATION}\n{source}'
+    return sha256(source.encode('utf-8')).hexdigest()
+
+
+def cached(path: str, source: str, variant: str = '') -> str | None:
+    '''
+    Returns the python code cached at path if it was generated
+    from the given tin source with the same variant of options,
+    None otherwise.
+    '''
+    try:
+        with open(path, 'r') as f:
+            code = f.read()
+    except OSError:
+        return None
+    if code.startswith(f'# tin {source_hash(source, variant)}\n'):
+        return code
+    return None
+
+
+def save(path: str, source: str, code: str, variant: str = ''):
+    with open(path, 'w') as f:
+        f.write(f'# tin {source_hash(source, variant)}\n')
+        f.write(code)
+
+
+def run_python(code: str, args: list | None = None, filename='<tin>',
+               stdin=None):
+    if args is None:
+        args = []
+    namespace = {}
+    exec(compile(code, filename, 'exec'), namespace)
+    with reading(stdin):
+        return namespace['main']({i: arg for i, arg in enumerate(args)})
@@ -1,17 +1,32 @@
 from .AST import *
 from .environment import Environment
+from .output import output
+from .input import readline, reading
+from .rope import Rope, concat
 from random import randrange
 from io import TextIOWrapper
 from itertools import zip_longest
+from functools import partial
 
 
+'''
+Expressions are evaluated recursively, but tin calls never are.
+Paragraph calls can only happen at the level of a sentence, so every
+call pushes a Frame on an explicit stack and pana pops it.
+The depth of tin recursion is not limited by the python stack.
+'''
 
-        
 
-class ReturnError(Exception):
+class Frame:
 
-    def __init__(self, value):
-        self.value = value
+    def __init__(self, paragraph, env, assign=None):
+        self.paragraph = paragraph
+        self.env = env
+        self.i = 0
+        # Called with the value returned from this frame
+        self.assign = assign
+        # Set when this frame replaced its caller in a tail call
+        self.void = False
 
 
 def represent(val):
@@ -24,6 +39,8 @@ def represent(val):
             return '[nanpa]'
         case str():
             return val
+        case Rope():
+            return str(val)
         case Paragraph():
             return '[pali]'
         case dict():
@@ -36,10 +53,7 @@ def represent(val):
             raise ValueError(a)
 
 
-def walk(expr, pali_ni=None, env=None):
-##    print(expr)
-    if env is None:
-        env = Environment()
+def evaluate(expr, pali_ni, env):
     match expr:
         case LiteralExpr():
             return expr.value
@@ -54,7 +68,7 @@ def walk(expr, pali_ni=None, env=None):
         case RecursiveExpr():
             return pali_ni
         case NegateExpr():
-            match walk(expr.expr, pali_ni, env):
+            match evaluate(expr.expr, pali_ni, env):
                 case bool() as b:
                     return not b
                 case int() as i:
@@ -62,11 +76,11 @@ def walk(expr, pali_ni=None, env=None):
                 case a:
                     return None
         case BinExpr(op='li'):
-            return walk(expr.left, pali_ni, env) == walk(expr.right, pali_ni, env)
+            return evaluate(expr.left, pali_ni, env) == evaluate(expr.right, pali_ni, env)
         case BinExpr(op='en'):
-            match walk(expr.left, pali_ni, env), walk(expr.right, pali_ni, env):
-                case str() as a, str() as b:
-                    return a + b
+            match evaluate(expr.left, pali_ni, env), evaluate(expr.right, pali_ni, env):
+                case str() | Rope() as a, str() | Rope() as b:
+                    return concat(a, b)
                 case bool(), _:
                     return None
                 case _, bool():
@@ -76,14 +90,14 @@ def walk(expr, pali_ni=None, env=None):
                 case _:
                     return None
         case BinExpr(op='pi'):
-            match walk(expr.left, pali_ni, env), walk(expr.right, pali_ni, env):
+            match evaluate(expr.left, pali_ni, env), evaluate(expr.right, pali_ni, env):
                 case dict() as a, b:
                     if b in a:
                         return a[b]
                     return None
                 case _, bool():
                     return None
-                case str() as a, int() as b:
+                case str() | Rope() as a, int() as b:
                     if 0 <= b < len(a):
                         return a[b]
                     return None
@@ -92,7 +106,7 @@ def walk(expr, pali_ni=None, env=None):
         case BinExpr(op=e):
             raise Exception(f'Wrong binary operator {e}')
         case ComparisonExpr(op='lili'):
-            match walk(expr.expr, pali_ni, env):
+            match evaluate(expr.expr, pali_ni, env):
                 case bool():
                     return False
                 case int() as i:
@@ -100,7 +114,7 @@ def walk(expr, pali_ni=None, env=None):
                 case _:
                     return False
         case ComparisonExpr(op='suli'):
-            match walk(expr.expr, pali_ni, env):
+            match evaluate(expr.expr, pali_ni, env):
                 case bool():
                     return False
                 case int() as i:
@@ -109,129 +123,184 @@ def walk(expr, pali_ni=None, env=None):
                     return False
         case ComparisonExpr(op=e):
             raise Exception(f'Wrong comparison operator {e}')
-        case VerbExpr(verb='pana', first=first):
-            raise ReturnError(walk(first, pali_ni, env))
         case VerbExpr(verb='lukin', first=first):
-            match walk(first, pali_ni, env):
-                case TextIOWrapper(closed=False) if first.readable():
-                    return first.readline()
+            source = evaluate(first, pali_ni, env)
+            output.flush()
+            match source:
+                case TextIOWrapper(closed=False) if source.readable():
+                    return source.readline()
                 case _:
-                    try:
-                        return input() + '\n'
-                    except EOFError as e:
-                        return ''
+                    return readline()
         case VerbExpr(verb='sitelen', first=first, args=[dest, *rest]):
-            match walk(dest, pali_ni, env), represent(walk(first, pali_ni, env)):
-                case TextIOWrapper(closed=False) as dest, first if dest.writeable():
-                    print(first, file=dest, end='')
+            match evaluate(dest, pali_ni, env), represent(evaluate(first, pali_ni, env)):
+                case TextIOWrapper(closed=False) as dest, first if dest.writable():
+                    output.write(first, dest)
                 case _, first:
-                    print(first, end='')
+                    output.write(first)
         case VerbExpr(verb='sitelen', first=first):
-            print(represent(walk(first, pali_ni, env)), end='')
+            output.write(represent(evaluate(first, pali_ni, env)))
         case VerbExpr(verb='kipisi', first=first, args=[start, stop, *rest]):
-            match walk(first, pali_ni, env), walk(start, pali_ni, env), walk(stop, pali_ni, env):
-                case str() as first, int() as start, int() as stop \
+            match evaluate(first, pali_ni, env), evaluate(start, pali_ni, env), evaluate(stop, pali_ni, env):
+                case str() | Rope() as first, int() as start, int() as stop \
                      if type(start) is not bool and type(stop) is not bool:
                     start = min(max(start, 0), len(first))
                     stop = min(max(stop, 0), len(first))
                     return first[start:stop]
-                case str() as first, int() as start, _ \
+                case str() | Rope() as first, int() as start, _ \
                      if type(start) is not bool:
                     start = min(max(start, 0), len(first))
                     return first[start:]
-                case str() as first, _, int() as stop \
+                case str() | Rope() as first, _, int() as stop \
                      if type(stop) is not bool: 
                     stop = min(max(stop, 0), len(first))
                     return first[:stop]
-                case str() as first, _, _:
+                case str() | Rope() as first, _, _:
                     return first
                 case _:
                     return None
         case VerbExpr(verb='kipisi', first=first, args=[start, *rest]):
-            match walk(first, pali_ni, env), walk(start, pali_ni, env):
-                case str() as first, int() as start \
+            match evaluate(first, pali_ni, env), evaluate(start, pali_ni, env):
+                case str() | Rope() as first, int() as start \
                      if type(start) is not bool:
                     start = min(max(start, 0), len(first))
                     return first[start:]
-                case str() as first, _:
+                case str() | Rope() as first, _:
                     return first
                 case _:
                     return None
         case VerbExpr(verb='kipisi', first=first):
-            match walk(first, pali_ni, env):
-                case str() as first:
+            match evaluate(first, pali_ni, env):
+                case str() | Rope() as first:
                     return first
                 case _:
                     return None
         case VerbExpr(verb='open', first=first, args=[mode, *rest]):
-            match walk(first, pali_ni, env), walk(mode, pali_ni, env):
-                case str() as first, 'sitelen' as mode:
+            match evaluate(first, pali_ni, env), evaluate(mode, pali_ni, env):
+                case str() | Rope() as first, 'sitelen' as mode:
                     try:
-                        return open(first, 'w')
+                        return open(str(first), 'w')
                     except Exception:
                         return None
-                case str() as first, _:
+                case str() | Rope() as first, _:
                     try:
-                        return open(first, 'r')
+                        return open(str(first), 'r')
                     except Exception:
                         return None
                 case _:
                     return None
         case VerbExpr(verb='open', first=first):
-            match walk(first, pali_ni, env):
-                case str() as first:
+            match evaluate(first, pali_ni, env):
+                case str() | Rope() as first:
                     try:
-                        return open(first, 'r')
+                        return open(str(first), 'r')
                     except Exception:
                         return None
                 case _:
                     return None
         case VerbExpr(verb='pini', first=first):
-            match walk(first, pali_ni, env):
+            match evaluate(first, pali_ni, env):
                 case TextIOWrapper(closed=False) as first:
-                    first.close()
+                    output.close(first)
             return None
-        case VerbExpr(verb='pali', first=first, args=args):
-            match walk(first, pali_ni, env):
-                case Paragraph() as p:
-                    new_env = Environment(env)
-                    for k, v in zip_longest(p.arguments, args[:len(p.arguments)]):
-                        if v is None:
-                            new_env.set_local(k.identifier, None)
-                        else:
-                            new_env.set_local(k.identifier, walk(v, pali_ni, env))
-                    return walk(p.sentences, p, new_env)
-                case _:
-                    return None
-        case Sentence(conditions=conditions,
-                      assignment=assignment,
-                      expr=subexpr):
-            for cond in conditions:
-                val = walk(cond, pali_ni, env)
+        case None:
+            return None
+        case a:
+            raise ValueError(a)
+
+
+def bind(paragraph, args, pali_ni, env, new_env):
+    for k, v in zip_longest(paragraph.arguments, args[:len(paragraph.arguments)]):
+        if v is None:
+            new_env.set_local(k.identifier, None)
+        else:
+            new_env.set_local(k.identifier, evaluate(v, pali_ni, env))
+    return new_env
+
+
+def execute(frame):
+    stack = []
+    while True:
+        sentences = frame.paragraph.sentences
+        if frame.i == len(sentences):
+            value = None
+        else:
+            sentence = sentences[frame.i]
+            frame.i += 1
+            pali_ni, env = frame.paragraph, frame.env
+            for cond in sentence.conditions:
+                val = evaluate(cond, pali_ni, env)
                 if val is False or val is None:
-                    return None
-            match assignment:
+                    break
+            else:
+                cond = None
+            if cond is not None:
+                continue
+            match sentence.assignment:
                 case None:
-                    return walk(subexpr, pali_ni, env)
+                    assign = None
                 case VariableExpr(var_type='lili', identifier=k):
-                    env.set_local(k, walk(subexpr, pali_ni, env))
+                    assign = partial(env.set_local, k)
                 case VariableExpr(var_type='suli', identifier=k):
-                    env.set_global(k, walk(subexpr, pali_ni, env))
+                    assign = partial(env.set_global, k)
                 case VariableExpr(identifier=k):
-                    env.set_first(k, walk(subexpr, pali_ni, env))
+                    assign = partial(env.set_first, k)
                 case TableAssignment(table=table, index=index):
-                    match walk(table, pali_ni, env):
+                    match evaluate(table, pali_ni, env):
                         case dict() as table:
-                            table[walk(index, pali_ni, env)] = walk(subexpr, pali_ni, env)
+                            assign = partial(table.__setitem__,
+                                             evaluate(index, pali_ni, env))
                         case _:
-                            return walk(subexpr, pali_ni, env)
-        case [*sentences]:
-            try:
-                for s in sentences:
-                    walk(s, pali_ni, env)
-            except ReturnError as e:
-                return e.value
-        case None:
-            return None
-        case a:
-            raise ValueError(a)
+                            assign = None
+            match sentence.expr:
+                case VerbExpr(verb='pana', first=first):
+                    value = evaluate(first, pali_ni, env)
+                case VerbExpr(verb='pali', first=first, args=args):
+                    match evaluate(first, pali_ni, env):
+                        case Paragraph() as p:
+                            if assign is None and frame.i == len(sentences):
+                                new_env = bind(p, args, pali_ni, env, env.tail())
+                                frame.paragraph, frame.env = p, new_env
+                                frame.i = 0
+                                frame.void = True
+                            else:
+                                stack.append(frame)
+                                new_env = bind(p, args, pali_ni, env, Environment(env))
+                                frame = Frame(p, new_env, assign)
+                        case _:
+                            if assign is not None:
+                                assign(None)
+                    continue
+                case subexpr:
+                    value = evaluate(subexpr, pali_ni, env)
+                    if assign is not None:
+                        assign(value)
+                    continue
+        if frame.void:
+            value = None
+        if frame.assign is not None:
+            frame.assign(value)
+        if not stack:
+            return value
+        frame = stack.pop()
+
+
+def walk(expr, pali_ni=None, env=None, stdin=None):
+    '''
+    lukin reads from stdin, a binary or text stream, if given.
+    '''
+    if env is None:
+        env = Environment()
+    try:
+        with reading(stdin):
+            match expr:
+                case VerbExpr(verb='pali', first=first, args=args):
+                    match evaluate(first, pali_ni, env):
+                        case Paragraph() as p:
+                            new_env = bind(p, args, pali_ni, env, Environment(env))
+                            return execute(Frame(p, new_env))
+                        case _:
+                            return None
+                case _:
+                    return evaluate(expr, pali_ni, env)
+    finally:
+        output.flush()
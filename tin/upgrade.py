@@ -0,0 +1,156 @@
+from .compiler import JMP, JEZ, COMMAND, SCALE, VERSION, \
+                       Constants, encode_literal, assemble
+from .virtual_machine import consume, IDENTIFIED, OPCODE_CHECK, \
+                             OPCODE_MASK, LENCODE_MASK, LENGTH_MASK
+
+
+'''
+Converts til bytecode of versions 0 and 1 to the current version.
+
+Instructions are read with their operands and written again with
+operands of the new width. Jumps are read as the old address of
+their target and written as offsets between the new addresses.
+
+Usage: python -m tin.upgrade <bytecode> [<destination>]
+Without a destination the bytecode file is overwritten.
+'''
+
+
+def read_paragraph(code, var_len: int, par_len: int) -> list:
+    '''
+    Returns the instructions of a version 0 or 1 paragraph as
+    (address, kind, operand) triples. kind is an opcode, 'int',
+    'str', 'jump' or 'jump if empty', the operand of a jump
+    is the address of its target.
+    '''
+    instructions = []
+    ip = 0
+    while ip < len(code):
+        start = ip
+        com, ip = consume(code, ip, 1)
+        if com & OPCODE_CHECK != 0:
+            opcode = com & OPCODE_MASK
+            operand = None
+            if opcode in IDENTIFIED:
+                operand, ip = consume(code, ip, var_len)
+            elif opcode == 3:
+                operand, ip = consume(code, ip, par_len)
+            elif opcode == SCALE:
+                operand, ip = consume(code, ip, 1)
+            instructions.append((start, opcode, operand))
+            continue
+        match com & LENCODE_MASK, com & LENGTH_MASK:
+            case 0, length:
+                val, ip = consume(code, ip, length)
+                instructions.append((start, 'int', val))
+            case 8, length:
+                length, ip = consume(code, ip, length)
+                val = bytes(code[ip:ip + length]).decode('utf-8')
+                ip += length
+                instructions.append((start, 'str', val))
+            case 16, length:
+                val, ip = consume(code, ip, length)
+                instructions.append((start, 'jump', ip + val))
+            case 24, length:
+                val, ip = consume(code, ip, length)
+                instructions.append((start, 'jump if empty', ip + val))
+            case a:
+                raise ValueError(('Invalid instruction', start, a))
+    instructions.append((ip, None, None))
+    return instructions
+
+
+def read(compiled) -> list:
+    '''
+    Returns the instructions of every paragraph of a version 0 or 1 program.
+    '''
+    var_len = compiled[1]
+    adr_len = compiled[2]
+    par_len = compiled[3]
+    par_tab_len, ip = consume(compiled, 4, par_len)
+    par_adr_tab = []
+    for _ in range(par_tab_len):
+        par_adr, ip = consume(compiled, ip, adr_len)
+        par_adr_tab.append(par_adr)
+    return [read_paragraph(compiled[ip + adr : ip + end], var_len, par_len)
+            for adr, end
+            in zip(par_adr_tab, par_adr_tab[1:] + [len(compiled) - ip])]
+
+
+def size(kind, operand, width: int) -> int:
+    if kind is None:
+        return 0
+    if type(kind) is int and operand is None:
+        return 1
+    return 1 + width
+
+
+def write_paragraph(instructions, width: int, constants, out):
+    '''
+    Raises OverflowError if any operand doesn't fit in width bytes.
+    '''
+    addresses = {}
+    ip = 0
+    for address, kind, operand in instructions:
+        addresses[address] = ip
+        ip += size(kind, operand, width)
+    start = len(out)
+    for address, kind, operand in instructions:
+        match kind:
+            case None:
+                pass
+            case 'int' | 'str':
+                out += encode_literal(operand, width, constants)
+            case 'jump' | 'jump if empty':
+                out.append(JMP if kind == 'jump' else JEZ)
+                end = addresses[address] + 1 + width
+                out += (addresses[operand] - end).to_bytes(width, 'big')
+            case _ if operand is None:
+                out.append(kind + COMMAND)
+            case _:
+                out.append(kind + COMMAND)
+                out += operand.to_bytes(width, 'big')
+    assert len(out) - start == ip
+
+
+def write(pars: list, width: int) -> bytearray:
+    constants = Constants()
+    compiled = bytearray()
+    addresses = []
+    for instructions in pars:
+        addresses.append(len(compiled))
+        write_paragraph(instructions, width, constants, compiled)
+    return assemble(width, addresses, compiled, constants)
+
+
+def upgrade(compiled) -> bytearray:
+    '''
+    Returns the bytecode converted to the current version.
+    '''
+    if compiled[0] == VERSION:
+        return bytearray(compiled)
+    if compiled[0] > VERSION:
+        raise ValueError(f'Unknown bytecode version {compiled[0]}')
+    pars = read(compiled)
+    width = 1
+    while True:
+        try:
+            return write(pars, width)
+        except OverflowError:
+            width += 1
+
+
+if __name__ == '__main__':
+    from sys import argv
+    match argv[1:]:
+        case [source]:
+            destination = source
+        case [source, destination]:
+            pass
+        case _:
+            print('Usage: python -m tin.upgrade <bytecode> [<destination>]')
+            exit()
+    with open(source, 'rb') as f:
+        compiled = f.read()
+    with open(destination, 'wb') as f:
+        f.write(upgrade(compiled))
@@ -1,11 +1,35 @@
 from .environment import Environment
+from .output import output
+from .input import readline, reading
+from .rope import Rope, STRINGS, concat
 from random import randrange
 from io import TextIOWrapper
+from time import perf_counter_ns
 
 
 '''
-Compatible with til bytecode version 0.
+Compatible with til bytecode versions 0 to 2.
 For more info see the docs folder.
+
+Every paragraph is decoded once, the first time it's called, into
+a list of (handler, operand) pairs. Operands are already converted to python
+values: literals to ints and strs, identifiers to ints and jump
+offsets to instruction indices within the paragraph.
+
+Variables looked up by dynamic scoping get an inline cache
+per instruction, see InlineCache.
+
+The bytecode may be any buffer, e.g. an mmap of a .til file.
+Paragraphs are decoded straight out of it through a memoryview,
+so loading doesn't copy the program and paragraphs which never run
+are never read.
+
+Every call gets a list of slots for the variables the compiler
+resolved to slots, sized by the largest slot its paragraph uses.
+
+Superinstructions are decoded into a single handler whose operand
+holds the operands of the instructions it replaces. Loads inside them
+are done by the value getters instead of pushing onto the stack.
 '''
 
 
@@ -31,6 +55,8 @@ def represent(val):
             return '[nanpa]'
         case str():
             return val
+        case Rope():
+            return str(val)
         case Paragraph():
             return '[pali]'
         case dict():
@@ -52,237 +78,847 @@ def consume(compiled: bytearray, start: int, length: int) -> (int, int):
     return ans, start
 
 
-def virtual_machine(compiled: bytearray, args: list | None = None):
-    if args is None:
-        args = []
-    version = compiled[0]
-    assert version <= 0
-    var_len = compiled[1]
-    adr_len = compiled[2]
-    par_len = compiled[3]
-    par_tab_len, ip = consume(compiled, 4, par_len)
-    par_adr_tab = []
-    for _ in range(par_tab_len):
-        par_adr, ip = consume(compiled, ip, adr_len)
-        par_adr_tab.append(par_adr)
-    pars = [compiled[ip + adr : ip + end] for adr, end
-            in zip(par_adr_tab, par_adr_tab[1:] + [len(compiled) - ip])]
-    data = [{i: arg for i, arg in enumerate(args)}]
-    ret = []
-    par = 0
+class InlineCache:
+    '''
+    Remembers in which frame the variable of one get_first or
+    set_first instruction was found and from which parent frame.
+
+    Frames above the parent of the running frame only gain new
+    variables through the running frame: set_local and tail call
+    merges only write to the running frame and its parent, and
+    set_first only writes to a frame already having the variable
+    (or the global frame, which is the last one anyway). So while
+    the running frame has the same parent as the last time and
+    neither of them has the variable it's found in the same frame.
+    '''
+
+    def __init__(self, identifier):
+        self.identifier = identifier
+        self.parent = None
+        self.holder = None
+
+
+def find(env: Environment, cache: InlineCache) -> Environment:
+    k = cache.identifier
+    if k in env.data:
+        return env
+    parent = env.parent
+    if parent is not None and parent is cache.parent:
+        if k in parent.data:
+            return parent
+        return cache.holder
+    holder = env.find(k)
+    cache.parent, cache.holder = parent, holder
+    return holder
+
+
+class Machine:
+
+    def __init__(self, pars, args):
+        self.pars = pars
+        self.data = [{i: arg for i, arg in enumerate(args)}]
+        self.ret = []
+        self.par = 0
+        self.code = pars[0]
+        self.ip = 0
+        self.env = Environment()
+        self.sizes = Sizes(pars)
+        self.slots = [None] * self.sizes[0]
+        # Set when the current frame was replaced by a tail call.
+        # Its caller expects ala as the result of the call.
+        self.void = False
+
+
+####   Handlers   ####
+
+'''
+Handlers are functions of type:
+(vm, operand) -> None | True
+Returning True stops the machine.
+'''
+
+def push(vm, value):
+    vm.data.append(value)
+
+
+def push_table(vm, _):
+    vm.data.append({})
+
+
+def push_paragraph(vm, identifier):
+    vm.data.append(Paragraph(identifier))
+
+
+def get_first(vm, cache):
+    vm.data.append(find(vm.env, cache).data.get(cache.identifier))
+
+
+def get_local(vm, identifier):
+    vm.data.append(vm.env.get_local(identifier))
+
+
+def get_global(vm, identifier):
+    vm.data.append(vm.env.get_global(identifier))
+
+
+def get_slot(vm, slot):
+    vm.data.append(vm.slots[slot])
+
+
+def random(vm, _):
+    vm.data.append(randrange(256))
+
+
+def recurse(vm, _):
+    vm.data.append(Paragraph(vm.par))
+
+
+def bigger_than_zero(vm, _):
+    data = vm.data
+    a = data.pop()
+    match a:
+        case bool():
+            data.append(False)
+        case int():
+            data.append(a > 0)
+        case _:
+            data.append(False)
+
+
+def smaller_than_zero(vm, _):
+    data = vm.data
+    a = data.pop()
+    match a:
+        case bool():
+            data.append(False)
+        case int():
+            data.append(a < 0)
+        case _:
+            data.append(False)
+
+
+def equal(vm, _):
+    data = vm.data
+    a, b = data.pop(), data.pop()
+    data.append(a == b and (type(a) is type(b)
+                            or type(a) in STRINGS and type(b) in STRINGS))
+
+
+def negate(vm, _):
+    data = vm.data
+    a = data.pop()
+    match a:
+        case bool():
+            data.append(not a)
+        case int():
+            data.append(-a)
+        case _:
+            data.append(None)
+
+
+def add(vm, _):
+    data = vm.data
+    a, b = data.pop(), data.pop()
+    match a, b:
+        case int(), int() if type(a) is not bool \
+             and type(b) is not bool:
+            data.append(b + a)
+        case str() | Rope(), str() | Rope():
+            data.append(concat(b, a))
+        case _:
+            data.append(None)
+
+
+def scale(vm, n):
+    data = vm.data
+    a = data.pop()
+    if type(a) is int or type(a) is str:
+        data.append(a * n)
+    elif type(a) is Rope:
+        data.append(str(a) * n)
+    else:
+        data.append(None)
+
+
+def pi(vm, _):
+    data = vm.data
+    a, b = data.pop(), data.pop()
+    match a, b:
+        case _, dict():
+            if a in b:
+                data.append(b[a])
+            else:
+                data.append(None)
+        case int(), str() | Rope() if type(a) is not bool:
+            if 0 <= a < len(b):
+                data.append(b[a])
+            else:
+                data.append(None)
+        case _:
+            data.append(None)
+
+
+def table_assign(vm, _):
+    data = vm.data
+    i, t, v = data.pop(), data.pop(), data.pop()
+    match i, t, v:
+        case _, dict(), _:
+            t[i] = v
+
+
+def set_first(vm, cache):
+    value = vm.data.pop()
+    find(vm.env, cache).data[cache.identifier] = value
+
+
+def set_local(vm, identifier):
+    if vm.data:
+        a = vm.data.pop()
+    else:
+        a = None
+    vm.env.set_local(identifier, a)
+
+
+def set_global(vm, identifier):
+    vm.env.set_global(identifier, vm.data.pop())
+
+
+def set_slot(vm, slot):
+    if vm.data:
+        a = vm.data.pop()
+    else:
+        a = None
+    vm.slots[slot] = a
+
+
+def drop(vm, _):
+    vm.data.pop()
+
+
+def empty(vm, _):
+    vm.data = []
+
+
+def jump(vm, target):
+    vm.ip = target
+
+
+def jump_if_empty(vm, target):
+    pred = vm.data.pop()
+    if pred is None or pred is False:
+        vm.ip = target
+
+
+def pali(vm, _):
+    match vm.data.pop():
+        case Paragraph(id=identifier):
+            vm.ret.append((vm.par, vm.ip, vm.env, vm.slots, vm.void))
+            vm.par, vm.ip, vm.env = identifier, 0, Environment(vm.env)
+            vm.code = vm.pars[identifier]
+            vm.slots = [None] * vm.sizes[identifier]
+            vm.void = False
+        case _:
+            vm.data = [None]
+
+
+def tail_pali(vm, _):
+    match vm.data.pop():
+        case Paragraph(id=identifier):
+            vm.par, vm.ip, vm.env = identifier, 0, vm.env.tail()
+            vm.code = vm.pars[identifier]
+            vm.slots = [None] * vm.sizes[identifier]
+            vm.void = True
+        case _:
+            vm.data = [None]
+
+
+def pana(vm, _):
+    if vm.void:
+        vm.data = [None]
+    else:
+        vm.data = [vm.data.pop()]
+    if vm.ret:
+        vm.par, vm.ip, vm.env, vm.slots, vm.void = vm.ret.pop()
+        vm.code = vm.pars[vm.par]
+    else:
+        return True
+
+
+def lukin(vm, _):
+    first = vm.data.pop()
+    output.flush()
+    match first:
+        case TextIOWrapper(closed=False) if first.readable():
+            vm.data = [first.readline()]
+        case _:
+            vm.data = [readline()]
+
+
+def sitelen(vm, _):
+    data = vm.data
+    first = data.pop()
+    if data:
+        arg = data.pop()
+    else:
+        arg = None
+    match arg:
+        case TextIOWrapper(closed=False) if arg.writable():
+            output.write(represent(first), arg)
+        case _:
+            output.write(represent(first))
+    vm.data = [None]
+
+
+def kipisi(vm, _):
+    data = vm.data
+    first = data.pop()
+    match first:
+        case str() | Rope():
+            if data:
+                start = data.pop()
+                match start:
+                    case int() if type(start) is not bool:
+                        start = min(max(0, start), len(first))
+                    case _:
+                        start = 0
+            else:
+                start = 0
+            if data:
+                end = data.pop()
+                match end:
+                    case int() if type(end) is not bool:
+                        end = max(min(len(first), end), start)
+                    case _:
+                        end = len(first)
+            else:
+                end = len(first)
+            vm.data = [first[start:end]]
+        case _:
+            vm.data = [None]
+
+
+def open_file(vm, _):
+    data = vm.data
+    first = data.pop()
+    if data:
+        mode = data.pop()
+    else:
+        mode = None
+    match first, mode:
+        case str() | Rope(), 'sitelen':
+            try:
+                vm.data = [open(str(first), 'w')]
+            except Exception:
+                vm.data = [None]
+        case str() | Rope(), _:
+            try:
+                vm.data = [open(str(first), 'r')]
+            except Exception:
+                vm.data = [None]
+        case _:
+            vm.data = [None]
+
+
+def pini(vm, _):
+    match vm.data.pop():
+        case TextIOWrapper(closed=False) as first:
+            output.close(first)
+    vm.data = [None]
+
+
+####   Superinstructions   ####
+
+'''
+Value getters are functions of type:
+(vm, operand) -> value
+reading a variable the same way as the matching load handler.
+'''
+
+def first_value(vm, cache):
+    return find(vm.env, cache).data.get(cache.identifier)
+
+
+def local_value(vm, identifier):
+    return vm.env.data.get(identifier)
+
+
+def global_value(vm, identifier):
+    return vm.env.globals.get(identifier)
+
+
+def slot_value(vm, slot):
+    return vm.slots[slot]
+
+
+VALUES = {
+    get_first : first_value,
+    get_local : local_value,
+    get_global: global_value,
+    get_slot  : slot_value,
+}
+
+
+def load_pi(vm, operand):
+    value, arg, key = operand
+    a = value(vm, arg)
+    match a:
+        case dict():
+            vm.data.append(a.get(key))
+        case str() | Rope() if type(key) is int and 0 <= key < len(a):
+            vm.data.append(a[key])
+        case _:
+            vm.data.append(None)
+
+
+def load_add(vm, operand):
+    value, arg, n = operand
+    a = value(vm, arg)
+    if type(a) is int:
+        vm.data.append(a + n)
+    else:
+        vm.data.append(None)
+
+
+def load_jump_if_empty(vm, operand):
+    value, arg, target = operand
+    pred = value(vm, arg)
+    if pred is None or pred is False:
+        vm.ip = target
+
+
+def set_empty(vm, operand):
+    setter, arg = operand
+    setter(vm, arg)
+    vm.data = []
+
+
+def invalid(vm, opcode):
+    raise ValueError((vm.par, vm.ip, opcode))
+
+
+HANDLERS = {
+    0 : (push, True),
+    1 : (push_table, None),
+    2 : (push, None),
+    4 : (get_first, None),
+    5 : (get_local, None),
+    6 : (get_global, None),
+    8 : (random, None),
+    9 : (recurse, None),
+    10: (bigger_than_zero, None),
+    11: (smaller_than_zero, None),
+    12: (equal, None),
+    13: (negate, None),
+    14: (add, None),
+    15: (pi, None),
+    16: (table_assign, None),
+    17: (set_first, None),
+    18: (set_local, None),
+    19: (set_global, None),
+    20: (get_slot, None),
+    21: (set_slot, None),
+    22: (drop, None),
+    23: (empty, None),
+    24: (scale, None),
+    48: (pali, None),
+    49: (pana, None),
+    50: (lukin, None),
+    51: (sitelen, None),
+    52: (kipisi, None),
+    53: (open_file, None),
+    54: (pini, None),
+    55: (tail_pali, None),
+}
+
+# Opcodes followed by a variable identifier or a slot
+IDENTIFIED = {4, 5, 6, 17, 18, 19, 20, 21}
+
+# Opcodes looking variables up by dynamic scoping
+CACHED = {4, 17}
+
+# Superinstructions and the handlers they fuse their loads into
+FUSED = {
+    25: load_pi,
+    26: load_add,
+    27: load_add,
+    28: load_jump_if_empty,
+}
+
+SET_EMPTY = 29
+
+
+####   Loading   ####
+
+VERSION = 2
+
+# Types of constants in the constant pool
+CONST_INT = 0
+CONST_STR = 1
+
+# Header flags
+DEBUG_TABLE = 0b00000001
+
+
+class Format:
+    '''
+    Operand lengths of a bytecode version. Literals and jumps of
+    versions 0 and 1 store their own lengths, their literal_len is
+    None. Versions without a constant pool store strings inline.
+    '''
+
+    def __init__(self, var_len, par_len, scale_len,
+                 literal_len=None, constants=None):
+        self.var_len = var_len
+        self.par_len = par_len
+        self.scale_len = scale_len
+        self.literal_len = literal_len
+        self.constants = constants
+
+
+class Constants(dict):
+    '''
+    The constant pool by index, constants are decoded when
+    they are first used, like paragraphs.
+    '''
+
+    def __init__(self, compiled, table, count, width):
+        super().__init__()
+        self.compiled = compiled
+        self.table = table
+        self.count = count
+        self.width = width
+        # Constant addresses are relative to the end of the table
+        self.start = table + (count + 1) * width
+        self.end = self.address(count)
+
+    def address(self, index: int) -> int:
+        adr, _ = consume(self.compiled, self.table + index * self.width,
+                         self.width)
+        return self.start + adr
+
+    def __missing__(self, index):
+        if not 0 <= index < self.count:
+            raise IndexError(index)
+        start, end = self.address(index), self.address(index + 1)
+        kind = self.compiled[start]
+        if kind == CONST_INT:
+            value, _ = consume(self.compiled, start + 1, end - start - 1)
+        elif kind == CONST_STR:
+            value = bytes(self.compiled[start + 1:end]).decode('utf-8')
+        else:
+            raise ValueError((index, kind))
+        self[index] = value
+        return value
+
+
+def decode_instruction(code: bytes, ip: int, fmt: Format):
+    '''
+    Returns the instruction starting at ip, the ip following it
+    and for jumps the ip of the jump target, None otherwise.
+    '''
+    com, ip = consume(code, ip, 1)
+    if com & OPCODE_CHECK != 0:
+        opcode = com & OPCODE_MASK
+        if opcode in IDENTIFIED:
+            identifier, ip = consume(code, ip, fmt.var_len)
+            if opcode in CACHED:
+                identifier = InlineCache(identifier)
+            return (HANDLERS[opcode][0], identifier), ip, None
+        elif opcode == 3:
+            identifier, ip = consume(code, ip, fmt.par_len)
+            return (push_paragraph, identifier), ip, None
+        elif opcode == 24:
+            n, ip = consume(code, ip, fmt.scale_len)
+            return (scale, n), ip, None
+        elif opcode in FUSED:
+            (load, arg), ip, _ = decode_instruction(code, ip, fmt)
+            (_, val), ip, target = decode_instruction(code, ip, fmt)
+            if load not in VALUES:
+                return (invalid, opcode), ip, None
+            if opcode == 27:
+                val = -val
+            return (FUSED[opcode], (VALUES[load], arg, val)), ip, target
+        elif opcode == SET_EMPTY:
+            instruction, ip, _ = decode_instruction(code, ip, fmt)
+            return (set_empty, instruction), ip, None
+        elif opcode in HANDLERS:
+            return HANDLERS[opcode], ip, None
+        else:
+            return (invalid, opcode), ip, None
+    length = com & LENGTH_MASK
+    if fmt.literal_len is not None:
+        length = fmt.literal_len
+    match com & LENCODE_MASK:
+        case 0:
+            val, ip = consume(code, ip, length)
+            return (push, val), ip, None
+        case 8 if fmt.constants is not None:
+            index, ip = consume(code, ip, length)
+            return (push, fmt.constants[index]), ip, None
+        case 8:
+            length, ip = consume(code, ip, length)
+            val = bytes(code[ip:ip + length]).decode('utf-8')
+            return (push, val), ip + length, None
+        case 16:
+            val, ip = consume(code, ip, length)
+            return (jump, None), ip, ip + val
+        case 24:
+            val, ip = consume(code, ip, length)
+            return (jump_if_empty, None), ip, ip + val
+        case a:
+            return (invalid, (a, length)), ip, None
+
+
+def decode(code: bytes, fmt: Format) -> list:
+    instructions, _ = decode_indexed(code, fmt)
+    return instructions
+
+
+def decode_indexed(code: bytes, fmt: Format) -> (list, dict):
+    '''
+    Returns the decoded instructions and the index of the
+    instruction decoded from every address.
+    '''
+    instructions = []
+    indices = {}
+    jumps = []
     ip = 0
-    env = Environment()
-    while True:
-        if par > len(pars):
-            print(ret)
-            return
-        com, ip = consume(pars[par], ip, 1)
-##        print(len(ret), par, com)
-        if com & OPCODE_CHECK != 0:
-            match com & OPCODE_MASK:
-                case 0:
-                    data.append(True)
-                case 1:
-                    data.append({})
-                case 2:
-                    data.append(None)
-                case 3:
-                    identifier, ip = consume(pars[par], ip, par_len)
-                    data.append(Paragraph(identifier))
-                case 4:
-                    identifier, ip = consume(pars[par], ip, var_len)
-                    data.append(env.get_first(identifier))
-                case 5:
-                    identifier, ip = consume(pars[par], ip, var_len)
-                    data.append(env.get_local(identifier))
-                case 6:
-                    identifier, ip = consume(pars[par], ip, var_len)
-                    data.append(env.get_global(identifier))
-                case 8:
-                    data.append(randrange(256))
-                case 9:
-                    data.append(Paragraph(par))
-                case 10:
-                    a = data.pop()
-                    match a:
-                        case bool():
-                            data.append(False)
-                        case int():
-                            data.append(a > 0)
-                        case _:
-                            data.append(False)
-                case 11:
-                    a = data.pop()
-                    match a:
-                        case bool():
-                            data.append(False)
-                        case int():
-                            data.append(a < 0)
-                        case _:
-                            data.append(False)
-                case 12:
-                    a, b = data.pop(), data.pop()
-                    data.append(a == b and type(a) is type(b))
-                case 13:
-                    a = data.pop()
-                    match a:
-                        case bool():
-                            data.append(not a)
-                        case int():
-                            data.append(-a)
-                        case _:
-                            data.append(None)
-                case 14:
-                    a, b = data.pop(), data.pop()
-                    match a, b:
-                        case int(), int() if type(a) is not bool \
-                             and type(b) is not bool:
-                            data.append(b + a)
-                        case str(), str():
-                            data.append(b + a)
-                case 15:
-                    a, b = data.pop(), data.pop()
-                    match a, b:
-                        case _, dict():
-                            if a in b:
-                                data.append(b[a])
-                            else:
-                                data.append(None)
-                        case int(), str() if type(a) is not bool:
-                            if 0 <= a < len(b):
-                                data.append(b[a])
-                            else:
-                                data.append(None)
-                        case _:
-                            data.append(None)
-                case 16:
-                    i, t, v = data.pop(), data.pop(), data.pop()
-                    match i, t, v:
-                        case _, dict(), _:
-                            t[i] = v
-                case 17:
-                    a = data.pop()
-                    identifier, ip = consume(pars[par], ip, var_len)
-                    env.set_first(identifier, a)
-                case 18:
-                    if data:
-                        a = data.pop()
-                    else:
-                        a = None
-                    identifier, ip = consume(pars[par], ip, var_len)
-                    env.set_local(identifier, a)
-                case 19:
-                    a = data.pop()
-                    identifier, ip = consume(pars[par], ip, var_len)
-                    env.set_global(identifier, a)
-                case 22:
-                    data.pop()
-                case 23:
-                    data = []
-                case 48:
-                    match data.pop():
-                        case Paragraph(id=identifier):
-                            ret.append((par, ip, env))
-                            par, ip, env = identifier, 0, Environment(env)
-                        case _:
-                            data = [None]
-                case 49:
-                    data = [data.pop()]
-                    if ret:
-                        par, ip, env = ret.pop()
-                    else:
-                        break
-                case 50:
-                    first = data.pop()
-                    match first:
-                        case TextIOWrapper(closed=False) if first.readable():
-                            data = [first.readline()]
-                        case _:
-                            try:
-                                data = [input() + '\n']
-                            except EOFError as e:
-                                data = ['']
-                case 51:
-                    first = data.pop()
-                    if data:
-                        arg = data.pop()
-                    else:
-                        arg = None
-                    match arg:
-                        case TextIOWrapper(closed=False) if arg.writeable():
-                            print(represent(first), file=arg, end='')
-                        case _:
-                            print(represent(first), end='')
-                    data = [None]
-                case 52:
-                    first = data.pop()
-                    match first:
-                        case str():
-                            if data:
-                                start = data.pop()
-                                match start:
-                                    case int() if type(start) is not bool:
-                                        start = min(max(0, start), len(first))
-                                    case _:
-                                        start = 0
-                            else:
-                                start = 0
-                            if data:
-                                end = data.pop()
-                                match end:
-                                    case int() if type(end) is not bool:
-                                        end = max(min(len(first), end), start)
-                                    case _:
-                                        end = len(first), start
-                            else:
-                                end = len(first)
-                            data = [first[start:end]]
-                        case _:
-                            data = [None]
-                case 53:
-                    first = data.pop()
-                    if data:
-                        mode = data.pop()
-                    else:
-                        mode = None
-                    match first, mode:
-                        case str(), 'sitelen':
-                            try:
-                                data = [open(first, 'w')]
-                            except Exception:
-                                data = [None]
-                        case str(), _:
-                            try:
-                                data = [open(first, 'r')]
-                            except Exception:
-                                data = [None]
-                        case _:
-                            data = [None]
-                case 54:
-                    match data.pop():
-                        case TextIOWrapper(colsed=False) as first:
-                            first.close()
-                    data = [None]
-                case i:
-                    raise ValueError((par, ip, i))
+    while ip < len(code):
+        indices[ip] = len(instructions)
+        instruction, ip, target = decode_instruction(code, ip, fmt)
+        if target is not None:
+            jumps.append((len(instructions), target))
+        instructions.append(instruction)
+    indices[ip] = len(instructions)
+    for index, target in jumps:
+        handler, operand = instructions[index]
+        if handler is load_jump_if_empty:
+            value, arg, _ = operand
+            instructions[index] = (handler, (value, arg, indices[target]))
         else:
-            match com & LENCODE_MASK, com & LENGTH_MASK:
-                case 0, length:
-                    val, ip = consume(pars[par], ip, length)
-                    data.append(val)
-                case 8, length:
-                    length, ip = consume(pars[par], ip, length)
-                    val = pars[par][ip:ip + length].decode('utf-8')
-                    ip += length
-                    data.append(val)
-                case 16, length:
-                    val, ip = consume(pars[par], ip, length)
-                    ip += val
-                case 24, length:
-                    val, ip = consume(pars[par], ip, length)
-                    pred = data.pop()
-                    if pred is None or pred is False:
-                        ip += val
-                case a:
-                    raise ValueError((par, ip, a))
-    print('Program exited with', data[-1])
+            instructions[index] = (handler, indices[target])
+    return instructions, indices
+
+
+class Paragraphs(dict):
+    '''
+    Decoded paragraphs by identifier. A paragraph is decoded from the
+    bytecode when it's first looked up, reading its address and the
+    next one from the paragraph table.
+    '''
+
+    def __init__(self, compiled):
+        super().__init__()
+        self.compiled = memoryview(compiled)
+        # Address of the debug table, if there is one
+        self.debug = None
+        match self.compiled[0]:
+            case 0 | 1:
+                self.adr_len = self.compiled[2]
+                self.format = Format(self.compiled[1], self.compiled[3], 1)
+                self.count, self.table = consume(self.compiled, 4,
+                                                 self.format.par_len)
+                # Addresses are relative to the end of the table
+                self.start = self.table + self.count * self.adr_len
+            case 2:
+                width = self.compiled[1]
+                adr_len = self.adr_len = self.compiled[2]
+                flags = self.compiled[3]
+                self.count, ip = consume(self.compiled, 4, adr_len)
+                count, self.table = consume(self.compiled, ip, adr_len)
+                constants = Constants(self.compiled,
+                                      self.table + self.count * adr_len,
+                                      count, adr_len)
+                self.format = Format(width, width, width, width, constants)
+                # Addresses are relative to the end of the constant pool
+                # and the debug table
+                self.start = constants.end
+                if flags & DEBUG_TABLE:
+                    length, self.debug = consume(self.compiled,
+                                                 self.start, adr_len)
+                    self.start = self.debug + length
+            case version:
+                self.compiled.release()
+                raise ValueError(f'Unsupported bytecode version {version}, '
+                                 f'this VM runs versions 0 to {VERSION}')
+
+    def address(self, identifier: int) -> int:
+        if identifier == self.count:
+            return len(self.compiled)
+        adr, _ = consume(self.compiled,
+                         self.table + identifier * self.adr_len, self.adr_len)
+        return self.start + adr
+
+    def __missing__(self, identifier):
+        if not 0 <= identifier < self.count:
+            raise IndexError(identifier)
+        with self.compiled[self.address(identifier)
+                           : self.address(identifier + 1)] as code:
+            self[identifier] = decode(code, self.format)
+        return self[identifier]
+
+    def __len__(self):
+        return self.count
+
+    def positions(self, identifier: int) -> list:
+        '''
+        Returns (index, line, column) of every sentence of a paragraph
+        with a source position in the debug table, where index is the
+        index of its first decoded instruction. Empty without a table.
+        '''
+        if self.debug is None:
+            return []
+        compiled = self.compiled
+        width = compiled[self.debug]
+        ip = self.debug + 1
+        for _ in range(identifier):
+            count, ip = consume(compiled, ip, width)
+            ip += 3 * count * width
+        count, ip = consume(compiled, ip, width)
+        positions = []
+        for _ in range(count):
+            address, ip = consume(compiled, ip, width)
+            line, ip = consume(compiled, ip, width)
+            column, ip = consume(compiled, ip, width)
+            positions.append((address, line, column))
+        with compiled[self.address(identifier)
+                      : self.address(identifier + 1)] as code:
+            _, indices = decode_indexed(code, self.format)
+        return [(indices[address], line, column)
+                for address, line, column in positions]
+
+    def release(self):
+        '''
+        Releases the bytecode buffer, so an mmap can be closed
+        even if the machine is still referenced by a traceback.
+        '''
+        self.compiled.release()
+
+
+class Sizes(dict):
+    '''
+    Frame sizes of paragraphs by identifier, computed on first use.
+    '''
+
+    def __init__(self, pars):
+        super().__init__()
+        self.pars = pars
+
+    def __missing__(self, identifier):
+        self[identifier] = frame_size(self.pars[identifier])
+        return self[identifier]
+
+
+def load(compiled) -> Paragraphs:
+    return Paragraphs(compiled)
+
+
+def slot_used(handler, operand) -> int:
+    '''
+    Returns the slot used by an instruction, -1 if it uses none.
+    '''
+    if handler is get_slot or handler is set_slot:
+        return operand
+    if handler in FUSED.values() and operand[0] is slot_value:
+        return operand[1]
+    if handler is set_empty and operand[0] is set_slot:
+        return operand[1]
+    return -1
+
+
+def frame_size(code: list) -> int:
+    return max((slot_used(handler, operand) + 1 for handler, operand in code),
+               default=0)
+
+
+####   Execution   ####
+
+def execute(vm: Machine):
+    while True:
+        handler, operand = vm.code[vm.ip]
+        vm.ip += 1
+        if handler(vm, operand):
+            output.flush()
+            return vm.data[-1]
+
+
+class Profile:
+    '''
+    Execution counts and times in nanoseconds per instruction handler
+    and per paragraph. Time spent in a call is counted for the callee.
+    '''
+
+    def __init__(self):
+        self.instructions = {}
+        self.paragraphs = {}
+
+    def report(self) -> str:
+        total = sum(ns for _, ns in self.instructions.values()) or 1
+        lines = []
+        for title, stats in [('instruction', self.instructions),
+                             ('paragraph', self.paragraphs)]:
+            lines.append(f'{title:>20} {"count":>12} {"ms":>10} '
+                         f'{"ns/op":>8} {"%":>6}')
+            for key, (count, ns) in sorted(stats.items(),
+                                           key=lambda item: -item[1][1]):
+                lines.append(f'{key:>20} {count:>12} {ns / 1e6:>10.2f} '
+                             f'{ns / count:>8.0f} {100 * ns / total:>6.1f}')
+            lines.append('')
+        return '\n'.join(lines)
+
+    def as_dict(self) -> dict:
+        return {title: {str(key): {'count': count, 'ns': ns}
+                        for key, (count, ns) in stats.items()}
+                for title, stats in [('instructions', self.instructions),
+                                     ('paragraphs', self.paragraphs)]}
+
+
+def execute_profiled(vm: Machine, profile: Profile):
+    # A copy of execute, so that execute itself pays nothing for profiling
+    instructions = profile.instructions
+    paragraphs = profile.paragraphs
+    while True:
+        handler, operand = vm.code[vm.ip]
+        par = vm.par
+        vm.ip += 1
+        start = perf_counter_ns()
+        stop = handler(vm, operand)
+        ns = perf_counter_ns() - start
+        stats = instructions.setdefault(handler.__name__, [0, 0])
+        stats[0] += 1
+        stats[1] += ns
+        stats = paragraphs.setdefault(par, [0, 0])
+        stats[0] += 1
+        stats[1] += ns
+        if stop:
+            output.flush()
+            return vm.data[-1]
+
+
+def virtual_machine(compiled, args: list | None = None,
+                    profile: Profile | None = None, sampler=None, stdin=None):
+    '''
+    Runs the bytecode, recording its execution in profile if given
+    and sampling it with sampler (a tin.sampler.Sampler) if given.
+    lukin reads from stdin, a binary or text stream, if given.
+    '''
+    if args is None:
+        args = []
+    pars = load(compiled)
+    try:
+        vm = Machine(pars, args)
+        if sampler is not None:
+            sampler.start(vm)
+        try:
+            with reading(stdin):
+                if profile is None:
+                    ans = execute(vm)
+                else:
+                    ans = execute_profiled(vm, profile)
+        finally:
+            if sampler is not None:
+                sampler.stop()
+        print('Program exited with', ans)
+    finally:
+        output.flush()
+        pars.release()
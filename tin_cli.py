@@ -1,13 +1,19 @@
-from tin.AST import VerbExpr, LiteralExpr
-from tin.tree_walk import walk
-from tin.parser import parser, ParsingError
-from tin.compiler import compiler
-from tin.virtual_machine import virtual_machine
+from tin.virtual_machine import virtual_machine, Profile
+from tin.cache import lookup, store, default_directory
 
-from sys import argv
+from sys import argv, stderr
+from mmap import mmap, ACCESS_READ
+import os
+
+
+# The parser and the other backends are imported only when they are
+# needed, so running bytecode from the cache starts quickly.
 
 
 def parse_and_walk(p, args=None):
+    from tin.AST import VerbExpr, LiteralExpr
+    from tin.tree_walk import walk
+    from tin.parser import parser, ParsingError
     if args is None:
         args = []
     match parser(p):
@@ -17,6 +23,14 @@ def parse_and_walk(p, args=None):
             return walk(VerbExpr('pali', LiteralExpr(ast), [LiteralExpr(v) for v in args]))
 
 
+def report(profile, path=None):
+    print(profile.report(), file=stderr)
+    if path is not None:
+        import json
+        with open(path, 'w') as f:
+            json.dump(profile.as_dict(), f, indent=1)
+
+
 def help():
     print(
         'Command Line Interface for toki pi ilo nanpa.\n'
@@ -39,8 +53,22 @@ def help():
         '    -w\n'
         '        Requires -s.\n'
         '        The program passed with -s will be evaluated with a tree\n'
-        '        walker algorithm. Note that this is not efficient and may\n'
-        '        break on deep recursion.\n'
+        '        walker algorithm. Note that this is not efficient.\n'
+        '\n'
+        '    -c\n'
+        '        Requires -s.\n'
+        '        The program passed with -s will be compiled to python\n'
+        '        closures and evaluated.\n'
+        '\n'
+        '    -p\n'
+        '        Requires -s.\n'
+        '        The program passed with -s will be translated to python\n'
+        '        source code and executed.\n'
+        '\n'
+        '    -t <python>\n'
+        '        Requires -p.\n'
+        '        Path to a file caching the generated python source. It is\n'
+        '        reused as long as the source passed with -s doesn\'t change.\n'
         '\n'
         '    -r\n'
         '        Requires -s or -b\n'
@@ -49,29 +77,95 @@ def help():
         '        will be saved in the file passed with -b.\n'
         '        If only -b was passed: execute the bytecode passed with -b.\n'
         '\n'
+        '    -k <directory>\n'
+        '        Directory caching bytecode compiled from sources passed\n'
+        '        with -s, so unchanged sources aren\'t parsed and compiled\n'
+        '        again. Defaults to $XDG_CACHE_HOME/tin or ~/.cache/tin.\n'
+        '\n'
+        '    -n\n'
+        '        Don\'t use the bytecode cache.\n'
+        '\n'
+        '    -O <level>\n'
+        '        Optimize the program passed with -s before running or\n'
+        '        compiling it. Level 0 (default) doesn\'t change it, 1 folds\n'
+        '        constant expressions and 2 also removes sentences which\n'
+        '        can never be executed.\n'
+        '\n'
+        '    --profile\n'
+        '        Requires -r.\n'
+        '        Count and time the executed instructions per instruction\n'
+        '        and per paragraph and print a report to stderr at exit.\n'
+        '\n'
+        '    --profile-json <path>\n'
+        '        Like --profile, also saving the counts and times in\n'
+        '        nanoseconds as JSON in the given file.\n'
+        '\n'
+        '    -g\n'
+        '        Include a table of the source positions of sentences in\n'
+        '        the bytecode compiled from the source passed with -s.\n'
+        '\n'
+        '    --sample <path>\n'
+        '        Requires -r.\n'
+        '        Sample the call stack of the running program and save\n'
+        '        the samples as folded stacks for flamegraphs in the given\n'
+        '        file. Implies -g, frames of bytecode without source\n'
+        '        positions are named after instruction numbers.\n'
+        '\n'
         '    --\n'
         '        Indicates end of til_cli arguments. Rest of the arguments will\n'
         '        be passed to the program as a 0-indexed kulupu of strings\n'
-        '        if -r or -w were set.\n')
+        '        if -r, -w, -c or -p were set.\n')
 
 
 if __name__ == '__main__':
     args = argv[1:]
     wlk = False
+    closures = False
+    python = False
+    python_path = None
     source = None
     bytecode = None
     run = False
     program_args = []
+    cache = default_directory()
+    level = 0
+    profile = None
+    profile_path = None
+    debug = False
+    sampler = None
+    sample_path = None
     while len(args) > 0:
         match args:
             case ['-w', *args]:
                 wlk = True
             case ['-r', *args]:
                 run = True
+            case ['-c', *args]:
+                closures = True
+            case ['-p', *args]:
+                python = True
+            case ['-t', str() as python_path, *args]:
+                pass
             case ['-s', str() as source, *args]:
                 pass
             case ['-b', str() as bytecode, *args]:
                 pass
+            case ['-k', str() as cache, *args]:
+                pass
+            case ['-n', *args]:
+                cache = None
+            case ['-O', str() as level, *args] if level.isdigit():
+                level = int(level)
+            case ['-g', *args]:
+                debug = True
+            case ['--sample', str() as sample_path, *args]:
+                from tin.sampler import Sampler
+                sampler = Sampler()
+                debug = True
+            case ['--profile', *args]:
+                profile = Profile()
+            case ['--profile-json', str() as profile_path, *args]:
+                profile = Profile()
             case ['-h', *args]:
                 help()
                 exit()
@@ -84,40 +178,109 @@ if __name__ == '__main__':
         print('Option -w requires a source file passed with -s.\n'
               'See -h for help with options.')
         exit()
+    if closures and source is None:
+        print('Option -c requires a source file passed with -s.\n'
+              'See -h for help with options.')
+        exit()
+    if python and source is None:
+        print('Option -p requires a source file passed with -s.\n'
+              'See -h for help with options.')
+        exit()
+    if python_path is not None and not python:
+        print('Option -t requires -p.\n'
+              'See -h for help with options.')
+        exit()
     if run and source is None and bytecode is None:
         print('Option -r requires either a source file passed with -s\n'
               'or a bytecode file passed with -b.\n'
               'See -h for help with options.')
         exit()
     if source is None and bytecode is None or \
-       (source is None or bytecode is None) and not run and not wlk:
+       (source is None or bytecode is None) and not run and not wlk \
+       and not closures and not python:
         print('You didn\'t give me anything to do!\n'
               'See -h for help with options.')
         exit()
-    if wlk and run:
-        print('You can\'t both walk and run the program in the same call.\n'
-              'Only specify one of -r and -w.\n'
+    if profile is not None and not run:
+        print('Option --profile requires -r.\n'
+              'See -h for help with options.')
+        exit()
+    if sampler is not None and not run:
+        print('Option --sample requires -r.\n'
               'See -h for help with options.')
-    if source is not None:
+        exit()
+    if wlk + run + closures + python > 1:
+        print('You can\'t execute the program in more than one way in the\n'
+              'same call. Only specify one of -r, -w, -c and -p.\n'
+              'See -h for help with options.')
+        exit()
+    if python:
+        from tin.parser import parser, ParsingError
+        from tin.transpiler import transpiler, cached, save, run_python
+        from tin.optimizer import optimize
+        with open(source, 'r') as f:
+            text = f.read()
+        code = None
+        if python_path is not None:
+            code = cached(python_path, text, f'-O{level}')
+        if code is None:
+            AST = parser(text)
+            if isinstance(AST, ParsingError):
+                print(AST)
+                exit()
+            code = transpiler(optimize(AST, level))
+            if python_path is not None:
+                save(python_path, text, code, f'-O{level}')
+        ans = run_python(code, program_args, python_path or '<tin>')
+        print(f'Program exited with {ans}')
+    elif source is not None:
         with open(source, 'r') as f:
-            AST = parser(f.read())
+            text = f.read()
+        compiled = None
+        variant = f'-O{level}' + (' -g' if debug else '')
+        if cache is not None and not wlk and not closures:
+            compiled = lookup(cache, text, variant)
+        if compiled is None:
+            from tin.parser import parser, ParsingError
+            from tin.optimizer import optimize
+            AST = parser(text)
             if isinstance(AST, ParsingError):
                 print(AST)
                 exit()
-        walkable = VerbExpr('pali', LiteralExpr(AST),
-                            [LiteralExpr({i: v for i, v in enumerate(program_args)})])
+            AST = optimize(AST, level)
         if wlk:
+            from tin.AST import VerbExpr, LiteralExpr
+            from tin.tree_walk import walk
+            walkable = VerbExpr('pali', LiteralExpr(AST),
+                                [LiteralExpr({i: v for i, v in enumerate(program_args)})])
             ans = walk(walkable)
             print(f'Program exited with {ans}')
+        if closures:
+            from tin.closure_compiler import closure_compiler
+            ans = closure_compiler(AST)({i: v for i, v in enumerate(program_args)})
+            print(f'Program exited with {ans}')
         if bytecode is not None or run:
-            compiled = compiler(AST)
+            if compiled is None:
+                from tin.compiler import compiler
+                compiled = compiler(AST, debug)
+                if cache is not None:
+                    store(cache, text, compiled, variant)
             if bytecode is not None:
                 with open(bytecode, 'wb') as f:
                     f.write(compiled)
             if run:
-                virtual_machine(compiled, program_args)
+                virtual_machine(compiled, program_args, profile, sampler)
     elif bytecode is not None:
-        with open(bytecode, 'rb') as f:
-            compiled = f.read()
-        if run:
-            virtual_machine(compiled, program_args)
+        if os.path.getsize(bytecode) == 0:
+            print(f'{bytecode} is not a valid bytecode file, it\'s empty.')
+            exit()
+        # Mapped instead of read, the VM only touches the paragraphs it runs
+        with open(bytecode, 'rb') as f, \
+             mmap(f.fileno(), 0, access=ACCESS_READ) as compiled:
+            if run:
+                virtual_machine(compiled, program_args, profile, sampler)
+    if profile is not None:
+        report(profile, profile_path)
+    if sampler is not None:
+        with open(sample_path, 'w') as f:
+            f.write(sampler.folded())